@@ -1,10 +1,22 @@
+import sys
+import math
 import time
+import random
 import logging
 from django.conf import settings
 from django.core.cache.backends.base import BaseCache
 from django.core.cache import get_cache as get_django_cache, DEFAULT_CACHE_ALIAS
 from django.utils.functional import SimpleLazyObject
+from django.utils.importlib import import_module
 from celery.task import task
+from celery.exceptions import TimeoutError
+from celery.utils import uuid
+from jcache.local import LocalCache, SingleFlight, Waiter
+from jcache.executors import get_executor, CallResult, ThreadResult
+from jcache.guards import GUARDS, Semaphore
+from jcache.metrics import Metrics
+from jcache.packing import pack, unpack
+from jcache.tracker import AccessTracker
 
 
 logger = logging.getLogger(__name__)
@@ -14,19 +26,107 @@ logger = logging.getLogger(__name__)
 #logger.setLevel(logging.INFO)
 
 
+_generators = {}
+_generator_paths = {}
+
+
+def _generator_path(generator):
+    """
+    Returns the dotted import path of `generator`, or None if it can't
+    be imported again that way (eg it's a lambda or a method).
+    """
+    try:
+        return _generator_paths[generator]
+    except KeyError:
+        pass
+    except TypeError: # unhashable
+        return None
+
+    path = None
+    module = getattr(generator, '__module__', None)
+    name = getattr(generator, '__name__', None)
+    if module is not None and name is not None and \
+            getattr(sys.modules.get(module), name, None) is generator:
+        path = "%s.%s" % (module, name)
+        _generators.setdefault(path, generator)
+        # only module level functions are remembered; they live as long
+        # as their module anyway, whereas lambdas, closures and bound
+        # methods are often made afresh for each call
+        _generator_paths[generator] = path
+    return path
+
+
+def register_generator(generator, path):
+    """
+    Make `generator` importable as `path`, even though it isn't at
+    `path` (typically because it's been wrapped by a decorator, which
+    should call this when applied; see jcache.decorators.jcached).
+    """
+    _generators[path] = generator
+    _generator_paths[generator] = path
+
+
+def _import_generator(path):
+    """
+    The inverse of `_generator_path()`, caching what we've imported.
+    """
+    try:
+        return _generators[path]
+    except KeyError:
+        (module, name) = path.rsplit('.', 1)
+        module = import_module(module)
+        # importing may have registered it
+        if path in _generators:
+            return _generators[path]
+        generator = getattr(module, name)
+        _generators[path] = generator
+        return generator
+
+
+def _options(generator):
+    return getattr(generator, '_jcache_options', {})
+
+
 @task
-def invoke_async(jcache, key, version, generator, stale, args, kwargs, expires_at=None):
+def invoke_async(jcache, key, version, generator, stale, args, kwargs, expires_at=None, token=None):
+    """
+    Generate and set a value for `key`. `jcache` may be the alias of a
+    JCache in `settings.JCACHES` and `generator` the dotted import path
+    of the generator, which is how `JCache` sends them so task messages
+    stay small (and can be serialized as JSON).
+
+    `token` is what the JCache's guard gave us when we won the right to
+    regenerate, so we can release it when done.
+    """
     value = None
+    failed = False
     
+    if isinstance(jcache, basestring):
+        jcache = get_cache(jcache)
+    if isinstance(generator, basestring):
+        generator = _import_generator(generator)
+
     try:
         logger = invoke_async.get_logger()
         
-        if expires_at is None or expires_at > time.time():
+        started = time.time()
+        if expires_at is not None:
+            # expires_at was set to when we were queued, plus the deadline
+            jcache.metrics.timing('queue', started - expires_at + jcache._deadline(generator, stale), key)
+
+        if expires_at is None or expires_at > started:
             logger.debug("running generator %s" % generator)
             
-            value = generator(*args, **kwargs)
+            try:
+                value = generator(*args, **kwargs)
+            except Exception:
+                failed = True
+                jcache.metrics.incr('error', key)
+                raise
+            finished = time.time()
+            jcache.metrics.timing('generate', finished - started, key)
             
-            stale_at = time.time() + (stale or jcache.stale)
+            stale_at = finished + (stale or jcache.stale)
             
             logger.debug("setting key %s (%s/%s)" % (key, stale_at, jcache.expiry))
             jcache.set(
@@ -35,30 +135,286 @@ def invoke_async(jcache, key, version, generator, stale, args, kwargs, expires_a
                 stale_at=stale_at,
                 timeout=jcache.expiry,
                 version=version,
+                cost=(finished - started) if jcache.early_refresh else None,
             )
+            if jcache.backoff:
+                jcache._cache.delete("fail:%s" % key, version=version)
         else:
-            logger.debug('invoke_async (%s) expired while waiting for worker' % generator)
+            logger.warning('invoke_async (%s) for %s expired while waiting for worker' % (generator, key))
+            jcache.metrics.incr('expired', key)
     finally:
-        flag = jcache._decr_flag(key, version, 1 + (stale or jcache.stale))
+        if failed and jcache.backoff:
+            jcache._back_off(key, version, token)
+        else:
+            jcache.guard.release(key, version, token, 1 + (stale or jcache.stale))
+        semaphore = jcache._semaphore(generator)
+        if semaphore is not None:
+            semaphore.release()
 
     return value
 
+
+@task
+def invoke_async_batch(jobs):
+    """
+    Run several regenerations at once, each given as a tuple of the
+    arguments to `invoke_async()`, and return a list of their values
+    (None where the generator raised, or the job expired while waiting
+    for a worker).
+
+    Jobs are grouped by JCache and generator. Generators with
+    `_jcache_options` member `batch` set to True are called just once
+    for each group, with a list of `(args, kwargs)` pairs, and must
+    return a list of values in the same order; others are called once
+    per job. The values for each JCache (and version) are then written
+    with a single `set_many()`.
+    """
+    logger = invoke_async_batch.get_logger()
+    values = [None] * len(jobs)
+    groups = {}
+    now = time.time()
+
+    for (index, job) in enumerate(jobs):
+        (jcache, key, version, generator, stale, args, kwargs, expires_at, token) = job
+        if isinstance(jcache, basestring):
+            jcache = get_cache(jcache)
+        if isinstance(generator, basestring):
+            generator = _import_generator(generator)
+        if expires_at is not None:
+            jcache.metrics.timing('queue', now - expires_at + jcache._deadline(generator, stale), key)
+            if expires_at <= now:
+                logger.warning('invoke_async_batch (%s) for %s expired while waiting for worker' % (generator, key))
+                jcache.metrics.incr('expired', key)
+                jcache.guard.release(key, version, token, 1 + (stale or jcache.stale))
+                semaphore = jcache._semaphore(generator)
+                if semaphore is not None:
+                    semaphore.release()
+                continue
+        groups.setdefault((jcache, generator), []).append((index, key, version, stale, args, kwargs, token))
+
+    writes = {}
+    done = []
+    for ((jcache, generator), group) in groups.items():
+        logger.debug("running generator %s for %i keys" % (generator, len(group)))
+        started = time.time()
+        if _options(generator).get('batch'):
+            calls = [(args, kwargs) for (index, key, version, stale, args, kwargs, token) in group]
+            try:
+                outcomes = [(value, False) for value in generator(calls)]
+                if len(outcomes) != len(group):
+                    raise ValueError("batch generator returned %i values for %i calls" % (len(outcomes), len(group)))
+            except Exception:
+                logger.exception("batch generator %s failed" % generator)
+                outcomes = [(None, True)] * len(group)
+        else:
+            outcomes = []
+            for (index, key, version, stale, args, kwargs, token) in group:
+                try:
+                    outcomes.append((generator(*args, **kwargs), False))
+                except Exception:
+                    logger.exception("generator %s failed for %s" % (generator, key))
+                    outcomes.append((None, True))
+        finished = time.time()
+        # we can only share the cost out between them
+        cost = (finished - started) / len(group)
+
+        for ((index, key, version, stale, args, kwargs, token), (value, failed)) in zip(group, outcomes):
+            done.append((jcache, key, version, generator, stale, token, failed))
+            if failed:
+                jcache.metrics.incr('error', key)
+                continue
+            jcache.metrics.timing('generate', cost, key)
+            values[index] = value
+            writes.setdefault((jcache, version), {})[key] = (
+                value,
+                finished + (stale or jcache.stale),
+                cost if jcache.early_refresh else None,
+                )
+
+    try:
+        for ((jcache, version), entries) in writes.items():
+            jcache._set_many(entries, version=version)
+            if jcache.backoff:
+                jcache._cache.delete_many(["fail:%s" % key for key in entries], version=version)
+    finally:
+        for (jcache, key, version, generator, stale, token, failed) in done:
+            if failed and jcache.backoff:
+                jcache._back_off(key, version, token)
+            else:
+                jcache.guard.release(key, version, token, 1 + (stale or jcache.stale))
+            semaphore = jcache._semaphore(generator)
+            if semaphore is not None:
+                semaphore.release()
+
+    return values
+
+
+# how long tag generations last in the backend; if one disappears, it's
+# recreated as a new generation, invalidating everything with that tag
+TAG_TIMEOUT = 60 * 60 * 24 * 30
+
+# how many tag generations each JCache remembers in-process
+TAG_CACHE_ENTRIES = 1000
+
+
+@task
+def refresh_hot_keys(alias=None):
+    """
+    Freshen the hot keys of the JCache `alias`, or of all JCaches
+    which are tracking them; see jcache.tracker. Schedule this with
+    celery beat.
+    """
+    if alias is None:
+        aliases = settings.JCACHES.keys()
+    else:
+        aliases = [alias]
+    refreshed = 0
+    for alias in aliases:
+        jcache = get_cache(alias)
+        if jcache.tracker is not None:
+            refreshed += jcache.tracker.refresh()
+    return refreshed
+
+
+class _Generation(object):
+    """
+    Someone else's generation of a missing key, looking like the
+    results of an executor (see jcache.executors).
+    """
+
+    def __init__(self, jcache, key, version):
+        self.jcache = jcache
+        self.key = key
+        self.version = version
+
+    def ready(self):
+        generating = self.jcache._cache.get("task:%s" % self.key, version=self.version)
+        if generating is not None and generating[0] == 'failed':
+            return True
+        if generating is not None and generating[0] == 'celery':
+            return invoke_async.AsyncResult(generating[1]).ready()
+        return self.key in self.jcache._peek_many([self.key], self.version)
+
+    def get(self, timeout=None):
+        if timeout is None:
+            return self.jcache._await_generation(self.key, self.version)
+        return self.jcache._await_generation(self.key, self.version, time.time() + timeout)
+
+
+def _make_key(key):
+    if isinstance(key, list) or isinstance(key, tuple):
+        # conflate them with '-' to make the key
+        key = '-'.join(map(lambda x: unicode(x).encode('utf-8'), key))
+    return key
+
+
 class JCache(object):
     """
     JCache, ie a cache that behaves somewhat like varnish in that as well
     as keys having the states missing/fresh/expired there is a fourth state
     in the lifecycle, stale, between fresh & expired.
 
-    Uses Celery to make an async rebuild request, and uses a second
+    Uses Celery (or another executor, see jcache.executors) to make an
+    async rebuild request, and uses a second
     cache key with incr to prevent the async task from being scheduled
     twice. You really only want to use this with underlying cache
     backends that make incr atomic (memcache does, redis does with
-    Sean's feature/native-incr branch).
+    Sean's feature/native-incr branch). Alternatively, a lock made with
+    an atomic add can be used instead; see jcache.guards.
     """
 
-    def __init__(self, stale=240, expiry=None, cache=None):
+    def __init__(self,
+                 stale=240,
+                 expiry=None,
+                 cache=None,
+                 wait_timeout=30,
+                 poll_interval=0.1,
+                 local=None,
+                 early_refresh=None,
+                 alias=None,
+                 executor=None,
+                 executor_options=None,
+                 guard='counter',
+                 metrics=None,
+                 envelope=False,
+                 compress_threshold=None,
+                 backoff=None,
+                 backoff_max=600,
+                 grace=None,
+                 tag_cache_timeout=1,
+                 track=None,
+                 single_flight=False,
+                 replicas=1):
         """
         `stale` is the number of seconds before 
+
+        `wait_timeout` is the longest (in seconds) that we'll block
+        waiting for someone else's generation of a missing key, and
+        `poll_interval` how often we look for it while doing so.
+
+        `local`, if given, is a dictionary of options for a per-process
+        `LocalCache` (see jcache.local) put in front of the backend, eg
+        `{ 'max_entries': 1000, 'max_size': 10 * 1024 * 1024 }`.
+
+        `early_refresh`, if given, turns on probabilistic early refresh
+        (as in "Optimal Probabilistic Cache Stampede Prevention", aka
+        XFetch): we record how long the generator took alongside each
+        value, and treat it as stale a random amount of time before its
+        `stale_at`, weighted by that cost and scaled by `early_refresh`
+        (1.0 is a good start; higher refreshes earlier). This spreads
+        out the regeneration of keys that were all filled together.
+
+        `alias` is our name in `settings.JCACHES` (`get_cache()` sets
+        this). With it, regeneration tasks refer to us by name rather
+        than carrying a pickled copy of the JCache and its backend.
+
+        `executor` and `executor_options` choose what runs asynchronous
+        regeneration; see jcache.executors. The default is celery.
+
+        `guard` chooses how we make sure only one caller regenerates a
+        key at once, either 'counter' (the default) or 'lock'; see
+        jcache.guards.
+
+        `metrics`, if given, is a dictionary of options for reporting
+        hits, misses, regenerations, generator timings and so on; see
+        jcache.metrics.
+
+        If `envelope` is True, values are stored in a compact envelope
+        rather than a tuple, and compressed if their pickled size is over
+        `compress_threshold` bytes; see jcache.packing. Either way, values
+        stored in the other format can still be read.
+
+        If `backoff` is given, when a generator raises we won't try to
+        regenerate that key again for `backoff` seconds, doubling each
+        time it fails in a row up to `backoff_max`. Meanwhile the stale
+        value carries on being served. If `grace` is also given, we keep
+        a copy of each value for `grace` seconds past its expiry, and
+        serve that (regenerating as if it were stale) when the value
+        itself has expired.
+
+        Values may be given tags, which can be invalidated in one go by
+        `invalidate_tags()`. Each tag has a generation, which is folded
+        into the keys used; we remember the generations of the last
+        thousand or so tags used in-process for `tag_cache_timeout`
+        seconds, so other processes may take that long to notice that a
+        tag has been invalidated.
+
+        `track`, if given, is a dictionary of options for tracking our
+        hottest keys so that they can be refreshed before they go stale;
+        see jcache.tracker. The periodic task finds us by `alias`.
+
+        If `single_flight` is True, concurrent `get()`s of the same key
+        in this process share a single fetch from the backend (and any
+        regeneration or wait that goes with it).
+
+        `replicas` spreads reads of hot keys across a sharded backend:
+        each value is written to that many copies (in one `set_many()`),
+        under keys which will usually be on different shards, and each
+        read picks one copy at random. They share a single guard, so a
+        stale key is still only regenerated once. It's either a number
+        of copies for every key, or a dict of key prefix to number of
+        copies for keys starting with that prefix (the longest matching
+        prefix wins; other keys have just one copy).
         """
         if isinstance(cache, basestring):
             self._cache = get_django_cache(cache)
@@ -70,6 +426,64 @@ class JCache(object):
             raise TypeError("cache parameter must be None, the name of a Django cache, or a BaseCache object")
         self.stale = stale
         self.expiry = expiry
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.early_refresh = early_refresh
+        self.alias = alias
+        self.executor = get_executor(executor, executor_options)
+        self.guard = GUARDS[guard](self._cache)
+        self.metrics = Metrics(alias=alias, **(metrics or {}))
+        self.envelope = envelope
+        self.compress_threshold = compress_threshold
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.grace = grace
+        self.tag_cache_timeout = tag_cache_timeout
+        self._tags = LocalCache(max_entries=TAG_CACHE_ENTRIES)
+        if isinstance(replicas, dict):
+            self.replicas = sorted(replicas.items(), key=lambda item: len(item[0]), reverse=True)
+        else:
+            self.replicas = replicas
+        if track is not None:
+            self.tracker = AccessTracker(self, **track)
+        else:
+            self.tracker = None
+        if single_flight:
+            self._flights = SingleFlight()
+        else:
+            self._flights = None
+        if local is not None:
+            self._local = LocalCache(**local)
+        else:
+            self._local = None
+        self._waiter = Waiter(poll_interval)
+
+    def __getstate__(self):
+        """
+        JCaches without an alias are pickled into regeneration tasks.
+        What only makes sense in this process (and holds locks, so can't
+        be pickled) is left out, and made afresh by `__setstate__()`.
+        """
+        state = self.__dict__.copy()
+        del state['_waiter']
+        del state['_tags']
+        if self._local is not None:
+            state['_local'] = { 'max_entries': self._local.max_entries, 'max_size': self._local.max_size }
+        state['_flights'] = self._flights is not None
+        return state
+
+    def __setstate__(self, state):
+        # tasks queued by older versions carry JCaches without the
+        # options added since, so anything missing gets its default
+        JCache.__init__(self, cache=state['_cache'])
+        self.__dict__.update(state)
+        if self._local is not None:
+            self._local = LocalCache(**self._local)
+        if self._flights:
+            self._flights = SingleFlight()
+        else:
+            self._flights = None
+        self._waiter = Waiter(self.poll_interval)
 
     def get(self,
             key,
@@ -107,149 +521,862 @@ class JCache(object):
         to work, the result will be passed back from celery, meaning
         it must be picklable.
 
+        Other `_jcache_options` control how regeneration is run: `queue`
+        and `priority` are passed to celery, `deadline` is how long (in
+        seconds, by default `stale`) it may wait for a worker before
+        being dropped, and `max_concurrency` limits how many
+        regenerations of stale values using this generator may be
+        queued or running at once, across all processes. Beyond that,
+        they're deferred: the stale value is served, and a later `get()`
+        tries again. Missing values are always regenerated, but count
+        towards the limit.
+
         If `async_wait_on_generate` is True then invoke_async will be
         executed via Celery. Else it will be invoked in the current
         thread instead.
+
+        `tags`, `budget` and `default` may only be given as keyword
+        arguments (so a generator can't have keyword arguments with those
+        names). `tags` is a list of tags for the key, which must be the
+        same as it was set with.
+
+        `budget`, if given, is the longest (in seconds) this call may
+        spend waiting on generation; after that we give up waiting,
+        although the generation carries on (in its own thread, if it's
+        not asynchronous). Whenever we'd return None, whether because
+        the key was missing or the wait took too long, we return
+        `default` instead.
         """
+        tags = kwargs.pop('tags', None)
+        budget = kwargs.pop('budget', None)
+        default = kwargs.pop('default', None)
+
+        key = self._tag_key(_make_key(key), tags)
+        if budget is not None:
+            deadline = time.time() + budget
+        else:
+            deadline = None
 
-        if isinstance(key, list) or isinstance(key, tuple):
-            # conflate them with '-' to make the key
-            key = '-'.join(map(lambda x: unicode(x).encode('utf-8'), key))
+        local = self._start(key, version, generator, stale, args, kwargs)
+        if local is not None:
+            return local[0]
+
+        fetch = lambda deadline: self._get(
+            key,
+            version,
+            stale,
+            generator,
+            wait_on_generate,
+            async_wait_on_generate,
+            args,
+            kwargs,
+            deadline,
+            )
+        if self._flights is not None:
+            # the shared fetch waits as long as it takes, and each of us
+            # only waits for it until our own deadline; callers who'd
+            # generate or wait on generation mustn't share with those
+            # who wouldn't, or they might get None
+            value = self._flights.do(
+                (key, version, generator is not None, bool(wait_on_generate)),
+                lambda: fetch(None),
+                max(0, deadline - time.time()) if deadline is not None else None,
+                )
+        else:
+            value = fetch(deadline)
+        if value is None:
+            return default
+        return value
+
+    def aget(self,
+             key,
+             version=None,
+             stale=None,
+             generator=None,
+             wait_on_generate=False,
+             *args, **kwargs):
+        """
+        As `get()`, but returns a `concurrent.futures.Future` of the
+        value (so this needs the `futures` package), without blocking
+        on generation: any waiting is done by a single thread shared by
+        all callers (see jcache.local.Waiter). Event loops can wait on
+        the future, eg with tornado's `IOLoop.add_future()`, or with
+        `asyncio.wrap_future()` where there's asyncio.
 
-        flag = None
+        Generation always goes through our executor, as if
+        `async_wait_on_generate` were True, and `lazy_result` is ignored.
+        Without a `budget`, we wait at most `wait_timeout`, so the future
+        always resolves.
+        """
+        from concurrent.futures import Future
+        tags = kwargs.pop('tags', None)
+        budget = kwargs.pop('budget', None)
+        default = kwargs.pop('default', None)
+
+        future = Future()
+        key = self._tag_key(_make_key(key), tags)
+        if budget is not None:
+            deadline = time.time() + budget
+        else:
+            deadline = None
+
+        local = self._start(key, version, generator, stale, args, kwargs)
+        if local is not None:
+            future.set_result(local[0])
+            return future
+
+        waiting = []
+        try:
+            value = self._get(
+                key,
+                version,
+                stale,
+                generator,
+                wait_on_generate,
+                True,
+                args,
+                kwargs,
+                deadline,
+                lambda generator, result, deadline: waiting.append(result),
+                )
+        except Exception, e:
+            future.set_exception(e)
+            return future
+
+        if waiting:
+            if deadline is None:
+                # nobody may ever write the value (eg if whoever was
+                # generating it died), and we can't block a thread on it
+                deadline = time.time() + self.wait_timeout
+            self._waiter.add(waiting[0], future, deadline, default)
+        elif value is None:
+            future.set_result(default)
+        else:
+            future.set_result(value)
+        return future
+
+    def _start(self, key, version, generator, stale, args, kwargs):
+        """
+        What every read does before going to the backend: tell the
+        tracker, and look in the local cache, returning the `(value,
+        stale_at)` pair from there or None.
+        """
+        if self.tracker is not None and generator is not None:
+            path = _generator_path(generator)
+            if path is not None:
+                self.tracker.record(key, version, path, stale, args, kwargs)
+
+        # fresh values in the local cache need no network I/O at all
+        if self._local is not None:
+            local = self._local.get((key, version))
+            if local is not None:
+                self.metrics.incr('hit', key)
+                return local
+        return None
+
+    def _get(self,
+             key,
+             version,
+             stale,
+             generator,
+             wait_on_generate,
+             async_wait_on_generate,
+             args,
+             kwargs,
+             deadline=None,
+             wait=None):
+        """
+        The part of `get()` that goes to the backend. `wait(generator,
+        result, deadline)` is what we call to wait for a result if we
+        need to, by default `_wait()`.
+        """
+        if wait is None:
+            wait = self._wait
+        (value, missing, token) = self._fetch(key, version, stale, generator is not None)
+
+        try:
+            # only generate a value if we are the only active instance
+            if token is not None:
+                (result, handed_off) = self._dispatch(
+                    key,
+                    version,
+                    generator,
+                    stale,
+                    args,
+                    kwargs,
+                    wait_on_generate,
+                    async_wait_on_generate,
+                    missing,
+                    token,
+                    deadline,
+                )
+                if handed_off:
+                    token = None # let invoke_async release the guard
+                if result is not None:
+                    value = wait(generator, result, deadline)
+            elif generator is not None and wait_on_generate and missing:
+                # someone else is generating a value; rather than
+                # generating it again (a startup herd), wait for theirs
+                value = wait(generator, _Generation(self, key, version), deadline)
+        finally:
+            if token is not None:
+                self.guard.release(key, version, token, 1 + (stale or self.stale))
+
+        return value
+
+    def _fetch(self, key, version, stale, generate):
+        """
+        Read `key` from the backend, and if it's missing or stale and
+        `generate` is True, try to take its guard. Returns `(value,
+        missing, token)`, where `token` is None unless we won the guard.
+        """
         value = None
-        do_decr = False
-        generate = False
-        async_result = None
+        token = None
+        regenerate = False
         now = time.time()
             
         packed = self._cache.get(
-            "data:%s" % key,
+            self._data_key(key),
             default=None,
             version=version
             )
+
+        # past expiry, we may still have a copy we can treat as stale
+        if packed is None and self.grace:
+            packed = self._cache.get("grace:%s" % key, version=version)
+            if packed is not None:
+                packed = self._expired(packed)
         
         # no data for this key, we'll want to try and generate some
         if packed is None:
-            generate = generator is not None
-            if wait_on_generate:
-                logger.warning("jcache: Assuming flag:%s=1 due to missing data and wait_on_generate" % key)
-                # we'll get a startup herd here; another approach is to
-                # instead wait until there's a value, but that's harder
-                # we'd need to store the task ID of the active invoke_async for this key in redis so we can make a
-                # AsyncResult here and wait for it to complete
-                flag = 1
-            value = None
+            self.metrics.incr('miss', key)
+            regenerate = generate
         else:
-            (value, stale_at) = packed
-            if stale_at < now:
-                generate = generator is not None
-    
+            (value, stale_at, cost) = unpack(packed)
+            refresh_at = self._refresh_at(stale_at, cost)
+            if refresh_at < now:
+                self.metrics.incr('stale', key)
+                regenerate = generate
+            else:
+                self.metrics.incr('hit', key)
+                if self._local is not None:
+                    self._local.set((key, version), value, refresh_at)
+
+        # we only need to take the guard if we are thinking about
+        # regenerating the key
+        if regenerate:
+            token = self.guard.acquire(key, version, 1 + (stale or self.stale))
+            logger.info('jcache: %s=%s, generate=%s token=%s', key, packed, regenerate, token)
+
+        return (value, packed is None, token)
+
+    def get_many(self,
+                 keys,
+                 version=None,
+                 stale=None,
+                 generator=None,
+                 wait_on_generate=False,
+                 async_wait_on_generate=False,
+                 *args, **kwargs):
+        """
+        Get several values at once, returning a dict of key to value
+        for those keys that have one (so like Django's `get_many()`).
+        Keys given as lists come back as tuples.
+
+        All the `data:` keys are fetched with a single backend
+        `get_many()`, and the guard for every stale or missing key is
+        taken together (with the default counter guard, in one round
+        trip if the backend has an `incr_many()`, otherwise one `incr`
+        per key). Regeneration is then dispatched only for those keys
+        where we won.
+
+        `generator` is called with `*args, **kwargs` as for `get()`,
+        unless `arguments` maps a key to its own `(args, kwargs)` pair.
+        The other parameters behave as for `get()`; `tags` apply to all
+        the keys. `arguments` and `tags` may only be given as keyword
+        arguments.
+        """
+        arguments = kwargs.pop('arguments', None)
+        tags = kwargs.pop('tags', None)
+
+        values = {}
+        made_keys = []
+        now = time.time()
+        if tags:
+            generations = self._tag_suffix(tags)
+        if self.tracker is not None and generator is not None:
+            path = _generator_path(generator)
+        else:
+            path = None
+        for key in keys:
+            if isinstance(key, list):
+                key = tuple(key)
+            made_key = _make_key(key)
+            if tags:
+                made_key += generations
+            if path is not None:
+                if arguments is not None and key in arguments:
+                    (key_args, key_kwargs) = arguments[key]
+                else:
+                    (key_args, key_kwargs) = (args, kwargs)
+                self.tracker.record(made_key, version, path, stale, key_args, key_kwargs)
+            if self._local is not None:
+                local = self._local.get((made_key, version), now)
+                if local is not None:
+                    self.metrics.incr('hit', made_key)
+                    values[key] = local[0]
+                    continue
+            made_keys.append((key, made_key))
+
+        if not made_keys:
+            return values
+
+        fetched = self._fetch_many(
+            list(set(made_key for (key, made_key) in made_keys)),
+            version,
+            stale,
+            generator is not None,
+            )
+
+        timeout = 1 + (stale or self.stale)
+        releases = dict(
+            (made_key, token)
+            for (made_key, (value, missing, token)) in fetched.items()
+            if token is not None
+            )
+        seen = set()
+        waiting = []
+        awaiting = []
         try:
-            # we only need to know the flag value if we are thinking about
-            # regenerating the key
-            if generate:
-                flag = self._incr_flag(key, version, 1 + (stale or self.stale))
-                do_decr = True
-                if flag < 1: # flag was <= -1 before incr, happens when flag expires just before decr was called
-                    logger.warning('jcache: key=%s flag=%s resetting to 1', key, flag)
-                    flag = self._reset_flag(key, version, 1 + (stale or self.stale), value=1)
-
-                logger.info('jcache: %s=%s, generate=%s flag=%s', key, packed, generate, flag)
-               
+            for (key, made_key) in made_keys:
+                (value, missing, token) = fetched[made_key]
+                if not missing:
+                    values[key] = value
+                if generator is None or made_key in seen:
+                    continue
+                seen.add(made_key)
                 # only generate a value if we are the only active instance
-                if generate and flag == 1:
-                    invoke_async_args = (
-                        self,
-                        key,
-                        version,
-                        generator,
-                        stale,
-                        args,
-                        kwargs,
-                        time.time() + (stale or self.stale)
-                    )
-                    
-                    # async invocation is desired
-                    if not wait_on_generate or (wait_on_generate and async_wait_on_generate):
-                        do_decr = False # let invoke_async decrement the flag
-                        logger.info('jcache: apply_sync generating data:%s' % key)
-                        async_result = invoke_async.apply_async(args=invoke_async_args)
-
-                    # block until we have a fresh value
-                    if wait_on_generate and packed is None:
-                        logger.info("jcache: waiting for data:%s", key)
-                        
-                        opts = getattr(generator, '_jcache_options', {})
-                        
-                        if async_result:
-                            result_func = lambda: async_result.get(propogate=True)
-                        else:
-                            do_decr = False # invoke_async being called locally still decrements the flag
-                            result_func = lambda: invoke_async(*invoke_async_args)
-
-                        if opts.get('lazy_result'):
-                            value = SimpleLazyObject(lambda: result_func())
-                        else:
-                            value = result_func() 
+                if token is None:
+                    if wait_on_generate and missing:
+                        awaiting.append((key, made_key))
+                    continue
+                if arguments is not None and key in arguments:
+                    (key_args, key_kwargs) = arguments[key]
+                else:
+                    (key_args, key_kwargs) = (args, kwargs)
+                (result, handed_off) = self._dispatch(
+                    made_key,
+                    version,
+                    generator,
+                    stale,
+                    key_args,
+                    key_kwargs,
+                    wait_on_generate,
+                    async_wait_on_generate,
+                    missing,
+                    token,
+                )
+                if handed_off:
+                    del releases[made_key] # let invoke_async release the guard
+                if result is not None:
+                    waiting.append((key, result))
         finally:
-            if do_decr:
-                self._decr_flag(key, version, 1 + (stale or self.stale))
+            if releases:
+                self.guard.release_many(releases, version, timeout)
 
-        return value
+        error = None
+        for (key, result) in waiting:
+            try:
+                values[key] = self._wait(generator, result)
+            except Exception:
+                # the rest may not have run yet (see CallResult), and
+                # hold guards until they have; raise once they're done
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
 
-    def _incr_flag(self, key, version, timeout=None):
-        try:
-            return self._cache.incr("flag:%s" % key, version=version)
-        except ValueError:
-            return self._reset_flag(key, version, timeout, 1)
+        # someone else is generating these; wait for their values
+        deadline = time.time() + self.wait_timeout
+        for (key, made_key) in awaiting:
+            values[key] = self._wait(generator, _Generation(self, made_key, version), deadline)
 
-    def _decr_flag(self, key, version, timeout=None):
-        try:
-            return self._cache.decr("flag:%s" % key, version=version)
-        except ValueError:
-            return self._reset_flag(key, version, timeout, 0)
+        return values
 
-    def _reset_flag(self, key, version, timeout=None, value=0):
-        self._cache.set("flag:%s" % key, value, version=version, timeout=timeout)
-        return value
+    def _fetch_many(self, keys, version, stale, generate):
+        """
+        As `_fetch()`, for several (made) keys at once, returning a dict
+        of key to `(value, missing, token)`.
+        """
+        now = time.time()
+        data_keys = dict((key, self._data_key(key)) for key in keys)
+        fetched = self._cache.get_many(data_keys.values(), version=version)
+        packed = dict(
+            (key, fetched[data_key])
+            for (key, data_key) in data_keys.items()
+            if data_key in fetched
+            )
+
+        if self.grace and len(packed) < len(keys):
+            grace = self._cache.get_many(
+                ["grace:%s" % key for key in keys if key not in packed],
+                version=version,
+                )
+            for (grace_key, entry) in grace.items():
+                packed[grace_key[len("grace:"):]] = self._expired(entry)
+
+        results = {}
+        to_generate = []
+        for key in keys:
+            entry = packed.get(key)
+            if entry is None:
+                self.metrics.incr('miss', key)
+                results[key] = (None, True, None)
+                to_generate.append(key)
+                continue
+            (value, stale_at, cost) = unpack(entry)
+            results[key] = (value, False, None)
+            refresh_at = self._refresh_at(stale_at, cost)
+            if refresh_at < now:
+                self.metrics.incr('stale', key)
+                to_generate.append(key)
+            else:
+                self.metrics.incr('hit', key)
+                if self._local is not None:
+                    self._local.set((key, version), value, refresh_at)
+
+        if generate and to_generate:
+            tokens = self.guard.acquire_many(to_generate, version, 1 + (stale or self.stale))
+            logger.info('jcache: get_many generate=%s tokens=%s', to_generate, tokens)
+            for key in to_generate:
+                (value, missing, token) = results[key]
+                results[key] = (value, missing, tokens[key])
+        return results
+
+    def _peek_many(self, keys, version=None):
+        """
+        Returns a dict of key to `(value, stale_at, cost)` for those of
+        (made) `keys` that have a value, without taking any guards or
+        recording metrics.
+        """
+        packed = self._cache.get_many(["data:%s" % key for key in keys], version=version)
+        return dict(
+            (key, unpack(packed["data:%s" % key]))
+            for key in keys
+            if "data:%s" % key in packed
+            )
+
+    def _tag_suffix(self, tags):
+        """
+        What to add to keys with `tags`, given their current generations.
+        """
+        generations = self._tag_generations(tags)
+        return '@' + '.'.join(str(generations[tag]) for tag in sorted(tags))
+
+    def _tag_key(self, key, tags):
+        if not tags:
+            return key
+        return key + self._tag_suffix(tags)
+
+    def _tag_generations(self, tags):
+        """
+        Returns a dict of the current generation of each of `tags`,
+        fetching those we haven't got cached in one go. Tags without a
+        generation are given one based on the time, so that a tag that
+        disappears from the backend doesn't reuse an old generation.
+        """
+        now = time.time()
+        generations = {}
+        fetch = []
+        for tag in tags:
+            cached = self._tags.get(tag, now)
+            if cached is not None:
+                generations[tag] = cached[0]
+            else:
+                fetch.append(tag)
+
+        if fetch:
+            fetched = self._cache.get_many(["tag:%s" % tag for tag in fetch])
+            for tag in fetch:
+                generation = fetched.get("tag:%s" % tag)
+                if generation is None:
+                    generation = int(now * 1000)
+                    if not self._cache.add("tag:%s" % tag, generation, timeout=TAG_TIMEOUT):
+                        generation = self._cache.get("tag:%s" % tag, generation)
+                generations[tag] = generation
+                if self.tag_cache_timeout:
+                    self._tags.set(tag, generation, now + self.tag_cache_timeout)
+        return generations
+
+    def invalidate_tags(self, *tags):
+        """
+        Invalidate every key with any of `tags`, by moving the tags on
+        to their next generation.
+        """
+        for tag in tags:
+            self._tags.delete(tag)
+            try:
+                self._cache.incr("tag:%s" % tag)
+            except ValueError:
+                self._cache.set("tag:%s" % tag, int(time.time() * 1000), timeout=TAG_TIMEOUT)
+
+    def _replicas(self, key):
+        """
+        How many copies of `key` we keep.
+        """
+        if isinstance(self.replicas, list):
+            for (prefix, replicas) in self.replicas:
+                if key.startswith(prefix):
+                    return replicas
+            return 1
+        return self.replicas
+
+    def _data_key(self, key):
+        """
+        The backend key of a copy of `key`, chosen at random.
+        """
+        replicas = self._replicas(key)
+        if replicas > 1:
+            replica = random.randrange(replicas)
+            if replica:
+                return "data:%s~%i" % (key, replica)
+        return "data:%s" % key
+
+    def _data_keys(self, key):
+        """
+        The backend keys of every copy of `key`.
+        """
+        return ["data:%s" % key] + ["data:%s~%i" % (key, replica) for replica in range(1, self._replicas(key))]
+
+    def _expired(self, packed):
+        """
+        Returns a grace copy of a value so that it's definitely stale.
+        """
+        (value, stale_at, cost) = unpack(packed)
+        return (value, 0)
+
+    def _back_off(self, key, version, token):
+        """
+        Regenerating `key` failed, so keep its guard held (without
+        anyone generating) for a while, doubling each time in a row.
+        Callers waiting for it give up rather than wait it out.
+        """
+        failures = (self._cache.get("fail:%s" % key, version=version) or 0) + 1
+        window = min(self.backoff_max, self.backoff * 2 ** (failures - 1))
+        logger.warning('jcache: generating %s has failed %i times, backing off for %is', key, failures, window)
+        self._cache.set("fail:%s" % key, failures, timeout=2 * window, version=version)
+        self._cache.set("task:%s" % key, ('failed', None), timeout=window, version=version)
+        self.guard.hold(key, version, token, window)
+        self.metrics.incr('backoff', key)
+
+    def _deadline(self, generator, stale):
+        """
+        How long a regeneration by `generator` may wait for a worker
+        before it's dropped.
+        """
+        return _options(generator).get('deadline') or stale or self.stale
+
+    def _semaphore(self, generator):
+        """
+        The `Semaphore` limiting concurrent regenerations by `generator`,
+        or None if it has no `max_concurrency`.
+        """
+        limit = _options(generator).get('max_concurrency')
+        if limit is None:
+            return None
+        name = _generator_path(generator) or getattr(generator, '__name__', repr(generator))
+        return Semaphore(self._cache, name, limit, 1 + self.stale)
+
+    def _routing(self, generator):
+        """
+        The celery routing options for regenerations by `generator`.
+        """
+        opts = _options(generator)
+        return dict((name, opts[name]) for name in ('queue', 'priority') if name in opts)
+
+    def _refresh_at(self, stale_at, cost):
+        """
+        When a value should be treated as stale: `stale_at`, unless we're
+        doing early refresh, when it's a random time before that drawn
+        from an exponential distribution scaled by the generator's cost.
+        """
+        if self.early_refresh and cost:
+            # log() of (0, 1] is <= 0, so this only ever brings it forward
+            return stale_at + cost * self.early_refresh * math.log(1.0 - random.random())
+        return stale_at
+
+    def _dispatch(self,
+                  key,
+                  version,
+                  generator,
+                  stale,
+                  args,
+                  kwargs,
+                  wait_on_generate,
+                  async_wait_on_generate,
+                  missing,
+                  token,
+                  deadline=None):
+        """
+        Arrange for `key` to be regenerated, once we've won its guard
+        and been given `token`.
+
+        Returns `(result, handed_off)`. `result` is what the caller
+        should wait on for the generated value (see jcache.executors),
+        or None if they shouldn't wait; `handed_off` is True if
+        `invoke_async` now owns releasing the guard. If the caller will
+        only wait until `deadline`, generation that would have run in
+        their thread gets a thread of its own.
+        """
+
+        async_result = None
+        handed_off = False
+        run_async = not wait_on_generate or (wait_on_generate and async_wait_on_generate)
+
+        if not run_async and not missing:
+            # a stale value with a synchronous wait_on_generate isn't
+            # regenerated; the caller just gets the stale value
+            return (None, False)
+
+        semaphore = self._semaphore(generator)
+        if semaphore is not None and not semaphore.acquire(force=missing):
+            logger.info('jcache: deferring regeneration of data:%s', key)
+            self.metrics.incr('deferred', key)
+            return (None, False)
+
+        invoke_async_args = self._task_args(key, version, generator, stale, args, kwargs, token)
+        self.metrics.incr('regeneration', key)
+        task_id = uuid()
+
+        if missing:
+            # record what's generating the value, so anyone else who
+            # wants it can wait for it (see _await_generation)
+            self._cache.set(
+                "task:%s" % key,
+                ('celery' if run_async and self.executor.remote else 'local', task_id),
+                timeout=1 + (stale or self.stale),
+                version=version,
+                )
+
+        # async invocation is desired
+        if run_async:
+            logger.info('jcache: apply_sync generating data:%s' % key)
+            try:
+                async_result = self.executor.submit(invoke_async_args, task_id, self._routing(generator))
+            except Exception:
+                # nothing will run to release the slot, or write the
+                # value anyone waiting on the task record expects
+                if semaphore is not None:
+                    semaphore.release()
+                if missing:
+                    self._cache.delete("task:%s" % key, version=version)
+                raise
+            handed_off = True
+
+        # block until we have a fresh value
+        if wait_on_generate and missing:
+            logger.info("jcache: waiting for data:%s", key)
+            if async_result:
+                return (async_result, handed_off)
+            # invoke_async being called locally still releases the guard
+            if deadline is not None:
+                return (ThreadResult(invoke_async, invoke_async_args), True)
+            return (CallResult(invoke_async, invoke_async_args), True)
+
+        return (None, handed_off)
+
+    def _task_args(self, key, version, generator, stale, args, kwargs, token=None):
+        """
+        The arguments to `invoke_async` to regenerate `key`. Where we
+        can, we send our alias and the generator's import path rather
+        than pickling them.
+        """
+        if self.alias is not None:
+            jcache = self.alias
+        else:
+            jcache = self
+        return (
+            jcache,
+            key,
+            version,
+            _generator_path(generator) or generator,
+            stale,
+            args,
+            kwargs,
+            time.time() + self._deadline(generator, stale),
+            token,
+        )
+
+    def _await_generation(self, key, version, deadline=None):
+        """
+        Wait until `deadline` (by default `wait_timeout` from now) for
+        someone else's generation of the missing `key` to finish,
+        returning the value or None if it doesn't arrive in time.
+
+        If the generation is a celery task, we wait on its result;
+        otherwise we poll the data key.
+        """
+        if deadline is None:
+            deadline = time.time() + self.wait_timeout
+
+        generating = self._cache.get("task:%s" % key, version=version)
+        if generating is not None and generating[0] == 'failed':
+            return None
+        if generating is not None and generating[0] == 'celery':
+            try:
+                return invoke_async.AsyncResult(generating[1]).get(
+                    timeout=max(0, deadline - time.time()),
+                    )
+            except TimeoutError:
+                logger.warning("jcache: timed out waiting for task %s generating data:%s", generating[1], key)
+                return None
+
+        while True:
+            peeked = self._peek_many([key], version)
+            if key in peeked:
+                return peeked[key][0]
+            if time.time() >= deadline:
+                logger.warning("jcache: timed out waiting for data:%s", key)
+                return None
+            time.sleep(self.poll_interval)
+
+    def _wait(self, generator, result, deadline=None):
+        """
+        Block for `result` (see jcache.executors), giving up with None
+        at `deadline` if given; or with the generator's `lazy_result`
+        option, return a lazy object that does so when resolved.
+        """
+        def get():
+            if deadline is None:
+                return result.get()
+            try:
+                return result.get(timeout=max(0, deadline - time.time()))
+            except TimeoutError:
+                logger.warning("jcache: gave up waiting for a generated value")
+                return None
+
+        if _options(generator).get('lazy_result'):
+            return SimpleLazyObject(get)
+        else:
+            return get()
 
     def set(self,
             key,
             value=None,
             stale_at=None,
             version=None,
-            timeout=None
+            timeout=None,
+            cost=None,
+            tags=None,
             ):
+        """
+        Set a value directly. `cost` is how long (in seconds) it took to
+        generate, which is used by early refresh.
+        """
+        key = self._tag_key(_make_key(key), tags)
         if timeout is None:
             timeout = self.expiry
         if stale_at is None:
             stale_at = time.time() + self.stale
+        if self._local is not None:
+            self._local.delete((key, version))
+        packed = self._pack(value, stale_at, cost)
+        if self.grace:
+            self._cache.set(
+                "grace:%s" % key,
+                packed,
+                timeout=(timeout or self._cache.default_timeout) + self.grace,
+                version=version,
+                )
+        if self._replicas(key) > 1:
+            return self._cache.set_many(
+                dict((data_key, packed) for data_key in self._data_keys(key)),
+                timeout=timeout,
+                version=version,
+                )
         return self._cache.set(
             "data:%s" % key,
-            (value, stale_at),
+            packed,
             timeout=timeout,
             version=version,
             )
 
-    def freshen(self, key, version=None, generator=None, stale=None, *args, **kwargs):
-        flag = self._incr_flag(key, version, 1 + (stale or self.stale))
-       
-        if flag > 1:
-            self._decr_flag(key, version)
+    def _pack(self, value, stale_at, cost=None):
+        if self.envelope:
+            return pack(value, stale_at, cost, self.compress_threshold)
+        elif cost is None:
+            return (value, stale_at)
         else:
-            logger.warning('jcache: (freshen) key=%s flag=%s resetting to 1', key, flag)
-            flag = self._reset_flag(key, version, 1 + (stale or self.stale), value=1)
-        
-        if flag == 1:
-            return invoke_async.apply_async(
-                args=(self, key, version, generator, stale, args, kwargs, time.time() + (stale or self.stale)),
+            return (value, stale_at, cost)
+
+    def _set_many(self, entries, version=None, timeout=None):
+        """
+        Set several values at once (and all their copies), with a single
+        backend `set_many()` (two if we're keeping grace copies).
+        `entries` is a dict of (already made) key to `(value, stale_at,
+        cost)`.
+        """
+        if timeout is None:
+            timeout = self.expiry
+        packed = {}
+        for (key, (value, stale_at, cost)) in entries.items():
+            if self._local is not None:
+                self._local.delete((key, version))
+            packed[key] = self._pack(value, stale_at, cost)
+        if self.grace:
+            self._cache.set_many(
+                dict(("grace:%s" % key, entry) for (key, entry) in packed.items()),
+                timeout=(timeout or self._cache.default_timeout) + self.grace,
+                version=version,
+                )
+        self._cache.set_many(
+            dict(
+                (data_key, entry)
+                for (key, entry) in packed.items()
+                for data_key in self._data_keys(key)
+                ),
+            timeout=timeout,
+            version=version,
             )
 
-    def delete(self, key, version):
-        self._cache.delete(key, version=version)
+    def freshen(self, key, version=None, generator=None, stale=None, *args, **kwargs):
+        key = self._tag_key(_make_key(key), kwargs.pop('tags', None))
+        token = self.guard.acquire(key, version, 1 + (stale or self.stale))
+        
+        if token is not None:
+            semaphore = self._semaphore(generator)
+            if semaphore is not None and not semaphore.acquire():
+                self.metrics.incr('deferred', key)
+                self.guard.release(key, version, token, 1 + (stale or self.stale))
+                return None
+            self.metrics.incr('regeneration', key)
+            try:
+                return self.executor.submit(
+                    self._task_args(key, version, generator, stale, args, kwargs, token),
+                    uuid(),
+                    self._routing(generator),
+                )
+            except Exception:
+                if semaphore is not None:
+                    semaphore.release()
+                self.guard.release(key, version, token, 1 + (stale or self.stale))
+                raise
+
+    def delete(self, key, version=None, tags=None):
+        key = self._tag_key(_make_key(key), tags)
+        if self._local is not None:
+            self._local.delete((key, version))
+        data_keys = self._data_keys(key)
+        if self.grace:
+            data_keys.append("grace:%s" % key)
+        if len(data_keys) > 1:
+            self._cache.delete_many(data_keys, version=version)
+        else:
+            self._cache.delete(data_keys[0], version=version)
 
     def clear(self):
+        if self._local is not None:
+            self._local.clear()
         self._cache.clear()
 
 
@@ -257,6 +1384,12 @@ if not hasattr(settings, 'JCACHES'):
     settings.JCACHES = { DEFAULT_CACHE_ALIAS: { }, }
 
 
+# JCache subclasses that can be chosen with `engine` in settings.JCACHES
+ENGINES = {
+    'redis': 'jcache.redis_engine.RedisJCache',
+}
+
+
 _jcaches = {}
 def get_cache(name):
     if name not in _jcaches:
@@ -268,7 +1401,14 @@ def get_cache(name):
         else:
             #print "got config", config
             pass
-        _jcaches[name] = JCache(**config)
+        config = dict(config)
+        engine = config.pop('engine', None)
+        if engine is None:
+            jcache_class = JCache
+        else:
+            (module, class_name) = ENGINES.get(engine, engine).rsplit('.', 1)
+            jcache_class = getattr(import_module(module), class_name)
+        _jcaches[name] = jcache_class(alias=name, **config)
     return _jcaches[name]
 
 
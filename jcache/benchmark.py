@@ -0,0 +1,163 @@
+"""
+A load simulation for JCache: some threads hammer `get()` on a set of
+keys held in a `LocMemCache`, wrapped in a `CountingCache` so we can see
+how many backend operations each `get()` costs. Regeneration happens
+in-process (inline, or with a thread pool) rather than through celery.
+
+Run it with the `jcache_benchmark` management command. For each
+scenario it reports:
+
+ * ops/get: backend operations per `get()`
+ * herd: generator invocations per key that needed regenerating
+ * p50, p99: `get()` latency, in milliseconds
+ * gets/s: throughput across all threads
+
+The scenarios are:
+
+ * fresh: every key is fresh
+ * cold: every key is missing, and callers wait on generation
+ * stale: every key is stale, and regenerated in the background
+ * expired: every key has expired (so is missing, as far as we can
+   tell) and is regenerated in the background
+"""
+
+import time
+import random
+import threading
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from jcache import JCache
+
+
+class CountingCache(BaseCache):
+    """
+    Wraps another cache backend, recording the operations made on it.
+    """
+
+    def __init__(self, cache):
+        BaseCache.__init__(self, {})
+        self.cache = cache
+        self.ops = []
+
+    def _op(name):
+        def op(self, *args, **kwargs):
+            self.ops.append(name)
+            return getattr(self.cache, name)(*args, **kwargs)
+        op.__name__ = name
+        return op
+
+    add = _op('add')
+    get = _op('get')
+    set = _op('set')
+    delete = _op('delete')
+    incr = _op('incr')
+    decr = _op('decr')
+    get_many = _op('get_many')
+    set_many = _op('set_many')
+    delete_many = _op('delete_many')
+    has_key = _op('has_key')
+    clear = _op('clear')
+    del _op
+
+
+_generations = []
+_generations_lock = threading.Lock()
+
+
+def bench_generator(bench_key, delay):
+    with _generations_lock:
+        _generations.append(bench_key)
+    time.sleep(delay)
+    return "value for %s" % bench_key
+
+
+SCENARIOS = ('fresh', 'cold', 'stale', 'expired')
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_scenario(scenario,
+                 threads=8,
+                 keys=20,
+                 gets=200,
+                 delay=0.05,
+                 jcache_options=None):
+    """
+    Runs one scenario with `threads` threads each doing `gets` gets of
+    random keys out of `keys`; `delay` is how long the generator takes.
+    `jcache_options` are passed to the JCache, and default to using
+    the inline executor. Returns a dictionary of results.
+    """
+    options = { 'executor': 'inline', 'stale': 60, 'wait_timeout': 10, 'poll_interval': 0.01 }
+    options.update(jcache_options or {})
+    backend = CountingCache(LocMemCache('jcache-benchmark-%s' % scenario, { 'MAX_ENTRIES': keys * 10 }))
+    backend.clear()
+    jc = JCache(cache=backend, **options)
+    names = ["key%i" % i for i in range(keys)]
+
+    now = time.time()
+    for name in names:
+        if scenario == 'fresh':
+            jc.set(name, "initial")
+        elif scenario == 'stale':
+            jc.set(name, "initial", stale_at=now - 1)
+        elif scenario == 'expired':
+            # expired, but once regenerated before (so flags are about)
+            jc.set(name, "initial", timeout=1)
+    if scenario == 'expired':
+        time.sleep(1.1)
+
+    backend.ops = []
+    del _generations[:]
+    latencies = []
+    latencies_lock = threading.Lock()
+    start = threading.Event()
+
+    def hammer():
+        mine = []
+        start.wait()
+        for i in xrange(gets):
+            name = random.choice(names)
+            then = time.time()
+            jc.get(
+                name,
+                generator=bench_generator,
+                wait_on_generate=(scenario == 'cold'),
+                bench_key=name,
+                delay=delay,
+                )
+            mine.append(time.time() - then)
+        with latencies_lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=hammer) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    began = time.time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - began
+
+    latencies.sort()
+    regenerated = len(set(_generations))
+    return {
+        'scenario': scenario,
+        'gets': len(latencies),
+        'ops_per_get': float(len(backend.ops)) / max(1, len(latencies)),
+        'generations': len(_generations),
+        'herd': float(len(_generations)) / regenerated if regenerated else 0.0,
+        'p50': _percentile(latencies, 0.5) * 1000,
+        'p99': _percentile(latencies, 0.99) * 1000,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def format_result(result):
+    return "%(scenario)-8s %(gets)6i gets %(ops_per_get)6.2f ops/get %(herd)5.2f herd " \
+        "%(p50)8.2fms p50 %(p99)8.2fms p99 %(throughput)10.1f gets/s" % result
@@ -0,0 +1,178 @@
+import re
+import inspect
+import hashlib
+from functools import wraps
+from django.core.cache import DEFAULT_CACHE_ALIAS
+
+from jcache import get_cache, register_generator
+
+
+# memcached allows 250 bytes, but that has to include any KEY_PREFIX,
+# the version and our own "data:"
+MAX_KEY_LENGTH = 200
+
+# nor does memcached allow whitespace or control characters
+_unsafe = re.compile(r'[\x00-\x20\x7f]')
+
+# how many keys each decorated function remembers
+MEMO_SIZE = 1000
+
+
+def _escape(value):
+    # so that values can't run into each other, or be taken for a
+    # keyword argument or a non-string
+    return value.replace('~', '~~').replace('-', '~-').replace('=', '~=')
+
+
+def _encode(value):
+    """
+    How `value` appears in a key. Strings are given as they are (with
+    separators escaped); anything else is marked with a `~`, and unless
+    it's None, a bool or a number, with its type, so that eg `None` and
+    `'None'` make different keys.
+    """
+    if isinstance(value, str):
+        return _escape(value)
+    if isinstance(value, unicode):
+        return _escape(value.encode('utf-8'))
+    if isinstance(value, float):
+        return '~' + repr(value)
+    if value is None or isinstance(value, (bool, int, long)):
+        return '~' + str(value)
+    return '~%s:%s' % (type(value).__name__, _escape(unicode(value).encode('utf-8')))
+
+
+def _key_builder(func, prefix):
+    """
+    Returns a function of `(args, kwargs)` that makes a key for calling
+    `func` with those arguments. Working out how to do so is done once,
+    here: keyword arguments are put in positional order and defaults
+    filled in, so equivalent calls get the same key.
+    """
+    (names, varargs, varkw, defaults) = inspect.getargspec(func)
+    if defaults:
+        defaults = dict(zip(names[-len(defaults):], defaults))
+    else:
+        defaults = {}
+    prefix = prefix + ':'
+
+    def finish(key):
+        if len(key) > MAX_KEY_LENGTH or _unsafe.search(key):
+            return prefix + hashlib.md5(key).hexdigest()
+        return key
+
+    if varargs is None and varkw is None:
+        def build(args, kwargs):
+            values = list(args)
+            for name in names[len(args):]:
+                values.append(kwargs[name] if name in kwargs else defaults.get(name))
+            return finish(prefix + '-'.join(map(_encode, values)))
+    else:
+        def build(args, kwargs):
+            values = map(_encode, args)
+            for name in sorted(kwargs):
+                values.append("%s=%s" % (name, _encode(kwargs[name])))
+            return finish(prefix + '-'.join(values))
+    return build
+
+
+def jcached(cache=DEFAULT_CACHE_ALIAS,
+            stale=None,
+            key=None,
+            version=None,
+            wait_on_generate=False,
+            async_wait_on_generate=False,
+            tags=None,
+            budget=None):
+    """
+    Decorates a function so calling it gets its result from the JCache
+    called `cache`, with the function itself as the generator. (So the
+    same rules apply to its arguments and result as for `JCache.get()`;
+    also, it can't take arguments with the same name as those of
+    `JCache.get()`.)
+
+    By default the key is the function's module and name, followed by
+    its arguments (see `_encode()`); `key` may instead be a string to use in place of
+    the module and name, or a function taking the same arguments as
+    the decorated one that returns the key. Keys that are too long or
+    have characters memcached doesn't like are hashed.
+
+    `stale`, `version`, `wait_on_generate`, `async_wait_on_generate`,
+    `tags` and `budget` are passed on to `JCache.get()`.
+
+    The decorated function also has:
+
+     * `get_many(calls)`, where `calls` is a list of `(args, kwargs)`,
+       returning a list of the results, using `JCache.get_many()`
+     * `freshen(*args, **kwargs)`, to regenerate in the background
+     * `invalidate(*args, **kwargs)`, to delete the cached value
+     * `make_key(*args, **kwargs)`, to see what key would be used
+    """
+
+    def decorator(func):
+        path = "%s.%s" % (func.__module__, func.__name__)
+        register_generator(func, path)
+
+        if callable(key):
+            build = lambda args, kwargs: key(*args, **kwargs)
+        else:
+            build = _key_builder(func, key or path)
+
+        memo = {}
+        def make_key(*args, **kwargs):
+            if kwargs:
+                return build(args, kwargs)
+            # 1, 1.0 and True are equal, but make different keys
+            memo_key = args + tuple(map(type, args))
+            try:
+                return memo[memo_key]
+            except KeyError:
+                if len(memo) >= MEMO_SIZE:
+                    memo.clear()
+                made = memo[memo_key] = build(args, kwargs)
+                return made
+            except TypeError: # unhashable arguments
+                return build(args, kwargs)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return get_cache(cache).get(
+                make_key(*args, **kwargs),
+                version,
+                stale,
+                func,
+                wait_on_generate,
+                async_wait_on_generate,
+                *args,
+                tags=tags,
+                budget=budget,
+                **kwargs)
+
+        def get_many(calls):
+            calls = [(tuple(args), kwargs) for (args, kwargs) in calls]
+            keys = [make_key(*args, **kwargs) for (args, kwargs) in calls]
+            values = get_cache(cache).get_many(
+                keys,
+                version=version,
+                stale=stale,
+                generator=func,
+                wait_on_generate=wait_on_generate,
+                async_wait_on_generate=async_wait_on_generate,
+                arguments=dict(zip(keys, calls)),
+                tags=tags,
+                )
+            return [values.get(made_key) for made_key in keys]
+
+        def freshen(*args, **kwargs):
+            return get_cache(cache).freshen(make_key(*args, **kwargs), version, func, stale, *args, tags=tags, **kwargs)
+
+        def invalidate(*args, **kwargs):
+            get_cache(cache).delete(make_key(*args, **kwargs), version, tags)
+
+        wrapper.get_many = get_many
+        wrapper.freshen = freshen
+        wrapper.invalidate = invalidate
+        wrapper.make_key = make_key
+        return wrapper
+
+    return decorator
@@ -0,0 +1,317 @@
+"""
+Executors run `invoke_async` to regenerate JCache keys. A JCache uses
+Celery by default; pick another with its `executor` option (in
+`settings.JCACHES` or to the constructor), either as one of the names
+in `EXECUTORS`, the dotted path of an `Executor` subclass, or an
+instance. `executor_options` are passed to the executor's constructor.
+
+The thread and process pools need `concurrent.futures`, which on
+Python 2 means installing the `futures` package.
+
+The batch executor collects regenerations and sends them to celery
+together; add `jcache.middleware.BatchRegenerationMiddleware` to send
+each request's batch when it finishes.
+"""
+
+import logging
+import threading
+from celery.exceptions import TimeoutError
+from django.utils.importlib import import_module
+
+
+logger = logging.getLogger(__name__)
+
+
+class Executor(object):
+    """
+    Base class for executors. `submit()` should arrange for
+    `invoke_async(*args)` to be run, and return an object whose
+    `get(timeout=None)` blocks for and returns its result (raising
+    `celery.exceptions.TimeoutError` if `timeout` passes first), and
+    whose `ready()` says whether it has finished, like a celery result.
+
+    `routing` is a dict of the generator's `queue` and `priority`
+    options, where it has them; executors without queues ignore it.
+
+    If `remote` is True, the result can also be waited on from other
+    processes, by making a celery `AsyncResult` from `task_id`.
+    """
+
+    remote = False
+
+    def submit(self, args, task_id, routing=None):
+        raise NotImplementedError
+
+
+class CeleryExecutor(Executor):
+    """
+    Sends regeneration to a celery worker.
+    """
+
+    remote = True
+
+    def submit(self, args, task_id, routing=None):
+        from jcache import invoke_async
+        return invoke_async.apply_async(args=args, task_id=task_id, **(routing or {}))
+
+
+class InlineResult(object):
+    """
+    The result of something that has already run.
+    """
+
+    def __init__(self, value=None, exception=None):
+        self.value = value
+        self.exception = exception
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class CallResult(object):
+    """
+    The result of `func(*args)`, which is called (in the calling
+    thread) when the result is first got.
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self._result = None
+
+    def ready(self):
+        return self._result is not None
+
+    def get(self, timeout=None):
+        if self._result is None:
+            try:
+                self._result = InlineResult(value=self.func(*self.args))
+            except Exception, e:
+                self._result = InlineResult(exception=e)
+        return self._result.get()
+
+
+class ThreadResult(object):
+    """
+    The result of `func(*args)`, called in a thread of its own, so that
+    we can stop waiting for it without stopping it.
+    """
+
+    def __init__(self, func, args):
+        self._done = threading.Event()
+        self._result = None
+        thread = threading.Thread(target=self._run, args=(func, args))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._result = InlineResult(value=func(*args))
+        except Exception, e:
+            logger.exception("jcache: regeneration of %s failed", args[1])
+            self._result = InlineResult(exception=e)
+        finally:
+            self._done.set()
+
+    def ready(self):
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError()
+        return self._result.get()
+
+
+class InlineExecutor(Executor):
+    """
+    Regenerates immediately, in the calling thread. Exceptions from the
+    generator are only raised when you get the result, so as with the
+    other executors a failed regeneration doesn't fail the `get()`.
+    """
+
+    def submit(self, args, task_id, routing=None):
+        from jcache import invoke_async
+        try:
+            return InlineResult(value=invoke_async(*args))
+        except Exception, e:
+            logger.exception("jcache: inline regeneration of %s failed", args[1])
+            return InlineResult(exception=e)
+
+
+class FutureResult(object):
+    """
+    Adapts a `concurrent.futures.Future` to look like a celery result.
+    """
+
+    def __init__(self, future):
+        self.future = future
+
+    def ready(self):
+        return self.future.done()
+
+    def get(self, timeout=None):
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+        try:
+            return self.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise TimeoutError()
+
+
+def _invoke(args):
+    # module level so process pools can pickle it
+    from jcache import invoke_async
+    return invoke_async(*args)
+
+
+class PoolExecutor(Executor):
+    """
+    Regenerates in a `concurrent.futures` pool, created on first use.
+    """
+
+    pool_class = None
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            import concurrent.futures
+            self._pool = getattr(concurrent.futures, self.pool_class)(max_workers=self.max_workers)
+        return self._pool
+
+    def submit(self, args, task_id, routing=None):
+        return FutureResult(self._get_pool().submit(_invoke, args))
+
+
+class ThreadPoolExecutor(PoolExecutor):
+    pool_class = 'ThreadPoolExecutor'
+
+
+class ProcessPoolExecutor(PoolExecutor):
+    """
+    Note that the arguments are pickled to send to the pool, so the
+    same restrictions apply as with celery.
+    """
+
+    pool_class = 'ProcessPoolExecutor'
+
+
+class BatchResult(object):
+    """
+    The result of one job in a batch. Getting it sends the batch, if
+    that hasn't happened yet. Jobs whose generators raise give None.
+    """
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def ready(self):
+        # don't hurry the batch along just to see if it's done
+        return self.batch.result is not None and self.batch.result.ready()
+
+    def get(self, timeout=None):
+        result = self.batch.send()
+        return result.get(timeout=timeout)[self.index]
+
+
+class Batch(object):
+
+    def __init__(self, executor, routing):
+        self.executor = executor
+        self.routing = routing
+        self.jobs = []
+        self.result = None
+        self.timer = None
+        self._lock = threading.Lock()
+
+    def send(self):
+        with self._lock:
+            if self.result is None:
+                if self.timer is not None:
+                    self.timer.cancel()
+                self.executor._sending(self)
+                self.result = self.executor.send(self.jobs, self.routing)
+            return self.result
+
+
+class BatchExecutor(Executor):
+    """
+    Collects regenerations and sends them together as one
+    `invoke_async_batch` task, once `window` seconds have passed since
+    the first, once there are `max_size` of them, or on `flush()`.
+    Regenerations for different queues or priorities are batched
+    separately.
+    """
+
+    def __init__(self, window=0.1, max_size=100):
+        self.window = window
+        self.max_size = max_size
+        # routing -> Batch
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def submit(self, args, task_id, routing=None):
+        routing = tuple(sorted((routing or {}).items()))
+        with self._lock:
+            batch = self._batches.get(routing)
+            if batch is None:
+                batch = self._batches[routing] = Batch(self, routing)
+                batch.timer = threading.Timer(self.window, batch.send)
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.jobs.append(args)
+            index = len(batch.jobs) - 1
+            full = len(batch.jobs) >= self.max_size
+        if full:
+            batch.send()
+        return BatchResult(batch, index)
+
+    def _sending(self, batch):
+        # a batch being sent takes no more jobs
+        with self._lock:
+            if self._batches.get(batch.routing) is batch:
+                del self._batches[batch.routing]
+
+    def flush(self):
+        """
+        Send what we've collected so far.
+        """
+        for batch in self._batches.values():
+            batch.send()
+
+    def send(self, jobs, routing=()):
+        from jcache import invoke_async_batch
+        return invoke_async_batch.apply_async(args=(jobs,), **dict(routing))
+
+
+EXECUTORS = {
+    'celery': CeleryExecutor,
+    'inline': InlineExecutor,
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+    'batch': BatchExecutor,
+}
+
+
+def get_executor(executor=None, options=None):
+    """
+    Returns an `Executor` given an instance, a name from `EXECUTORS`,
+    the dotted path of an `Executor` class, or None for celery.
+    """
+    if isinstance(executor, Executor):
+        return executor
+    if executor is None:
+        executor = 'celery'
+    if executor in EXECUTORS:
+        executor_class = EXECUTORS[executor]
+    else:
+        (module, name) = executor.rsplit('.', 1)
+        executor_class = getattr(import_module(module), name)
+    return executor_class(**(options or {}))
@@ -0,0 +1,232 @@
+"""
+Guards make sure that only one caller regenerates a key at a time. A
+JCache uses a `CounterGuard` by default; pass `guard='lock'` (in
+`settings.JCACHES` or to the constructor) for a `LockGuard` instead.
+
+`acquire()` returns a token if the caller won the right to regenerate
+the key, or None if it lost; whoever ends up regenerating (usually
+`invoke_async`) calls `release()` with that token when done, or
+`hold()` to keep everyone else from regenerating it for a while (eg
+after it failed). The `_many()` variants work on several keys at once.
+
+A `Semaphore` limits how many regenerations run at once across all
+processes, for generators with a `max_concurrency` option.
+"""
+
+import logging
+from celery.utils import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+class CounterGuard(object):
+    """
+    Uses a second cache key per key, `flag:<key>`, which is incremented
+    by everyone who wants to regenerate it; whoever takes it to 1 wins.
+    Everyone decrements it again afterwards, so this needs a backend
+    with atomic INCR and DECR.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def acquire(self, key, version, timeout=None):
+        flag = self._incr_flag(key, version, timeout)
+        if flag < 1: # flag was <= -1 before incr, happens when flag expires just before decr was called
+            logger.warning('jcache: key=%s flag=%s resetting to 1', key, flag)
+            flag = self._reset_flag(key, version, timeout, value=1)
+        logger.info('jcache: flag:%s=%s', key, flag)
+        if flag == 1:
+            return True
+        self._decr_flag(key, version, timeout)
+        return None
+
+    def release(self, key, version, token, timeout=None):
+        self._decr_flag(key, version, timeout)
+
+    def hold(self, key, version, token, timeout):
+        # backends where incr keeps the expiry (memcached, redis) will
+        # let this go after timeout, whoever tries to acquire it
+        self._reset_flag(key, version, timeout, value=1)
+
+    def acquire_many(self, keys, version, timeout=None):
+        flags = self._incr_flags(keys, version, timeout)
+
+        resets = [key for (key, flag) in flags.items() if flag < 1]
+        if resets:
+            # see acquire(); flags that went negative are put back to 1
+            logger.warning('jcache: keys=%s resetting flags to 1', resets)
+            self._cache.set_many(
+                dict(("flag:%s" % key, 1) for key in resets),
+                timeout=timeout,
+                version=version,
+                )
+            for key in resets:
+                flags[key] = 1
+
+        logger.info('jcache: flags=%s', flags)
+        losers = [key for (key, flag) in flags.items() if flag != 1]
+        if losers:
+            self._decr_flags(losers, version, timeout)
+        return dict((key, True if flag == 1 else None) for (key, flag) in flags.items())
+
+    def release_many(self, tokens, version, timeout=None):
+        self._decr_flags(tokens.keys(), version, timeout)
+
+    def _incr_flag(self, key, version, timeout=None):
+        try:
+            return self._cache.incr("flag:%s" % key, version=version)
+        except ValueError:
+            return self._add_flag(key, version, timeout)
+
+    def _add_flag(self, key, version, timeout=None):
+        """
+        Create a missing flag at 1. Several callers may find it missing
+        at once (eg everyone, after a cache flush), so it's created with
+        an atomic `add()`: whoever adds it wins, and the others increment
+        it as they would have if it had been there.
+        """
+        if self._cache.add("flag:%s" % key, 1, timeout=timeout, version=version):
+            return 1
+        try:
+            return self._cache.incr("flag:%s" % key, version=version)
+        except ValueError:
+            # it's gone again already
+            return self._reset_flag(key, version, timeout, 1)
+
+    def _decr_flag(self, key, version, timeout=None):
+        try:
+            return self._cache.decr("flag:%s" % key, version=version)
+        except ValueError:
+            return self._reset_flag(key, version, timeout, 0)
+
+    def _incr_flags(self, keys, version, timeout=None):
+        """
+        Increment the flags for several keys, returning a dict of key to
+        new flag value. If the backend has an `incr_many()` (taking a
+        list of keys, and returning a dict of the new values of those
+        that existed) this is a single round trip, for instance by
+        pipelining INCRs in redis; otherwise it's one `incr` per key.
+        Either way, flags that turn out to be missing still cost one
+        `add` each (see `_add_flag()`).
+        """
+        incr_many = getattr(self._cache, 'incr_many', None)
+        if incr_many is None:
+            return dict((key, self._incr_flag(key, version, timeout)) for key in keys)
+
+        incremented = incr_many(["flag:%s" % key for key in keys], version=version)
+        flags = {}
+        for key in keys:
+            flags[key] = incremented.get("flag:%s" % key)
+        for (key, flag) in flags.items():
+            if flag is None:
+                flags[key] = self._add_flag(key, version, timeout)
+        return flags
+
+    def _decr_flags(self, keys, version, timeout=None):
+        """
+        Decrement the flags for several keys; see `_incr_flags()`.
+        """
+        decr_many = getattr(self._cache, 'decr_many', None)
+        if decr_many is None:
+            for key in keys:
+                self._decr_flag(key, version, timeout)
+            return
+
+        decremented = decr_many(["flag:%s" % key for key in keys], version=version)
+        missing = [key for key in keys if "flag:%s" % key not in decremented]
+        if missing:
+            self._cache.set_many(
+                dict(("flag:%s" % key, 0) for key in missing),
+                timeout=timeout,
+                version=version,
+                )
+
+    def _reset_flag(self, key, version, timeout=None, value=0):
+        self._cache.set("flag:%s" % key, value, version=version, timeout=timeout)
+        return value
+
+
+class LockGuard(object):
+    """
+    Uses an atomic `add()` of `lock:<key>`, holding a token unique to
+    the owner, which expires after `timeout` seconds so that a crashed
+    worker can't hold it forever. Losers pay for just the failed `add`.
+
+    Release only deletes the lock if it's still ours, but isn't atomic:
+    if our lock expires between checking and deleting, we may delete
+    someone else's.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def acquire(self, key, version, timeout=None):
+        token = uuid()
+        if self._cache.add("lock:%s" % key, token, timeout=timeout, version=version):
+            return token
+        return None
+
+    def release(self, key, version, token, timeout=None):
+        if self._cache.get("lock:%s" % key, version=version) == token:
+            self._cache.delete("lock:%s" % key, version=version)
+
+    def hold(self, key, version, token, timeout):
+        self._cache.set("lock:%s" % key, token, timeout=timeout, version=version)
+
+    def acquire_many(self, keys, version, timeout=None):
+        return dict((key, self.acquire(key, version, timeout)) for key in keys)
+
+    def release_many(self, tokens, version, timeout=None):
+        for (key, token) in tokens.items():
+            self.release(key, version, token, timeout)
+
+
+class Semaphore(object):
+    """
+    A counting semaphore allowing `limit` holders at once across every
+    process, kept in the backend as `sem:<name>`; like `CounterGuard`,
+    this needs atomic INCR and DECR. The count expires after `timeout`
+    seconds (with memcached and redis, from when it was created), so
+    holders that die without releasing can't keep it full forever.
+    """
+
+    def __init__(self, cache, name, limit, timeout=None):
+        self._cache = cache
+        self.key = "sem:%s" % name
+        self.limit = limit
+        self.timeout = timeout
+
+    def acquire(self, force=False):
+        """
+        Take a slot, returning True, or False if they were all taken.
+        With `force` we take one regardless, which can go over `limit`.
+        """
+        try:
+            count = self._cache.incr(self.key)
+        except ValueError:
+            if self._cache.add(self.key, 1, timeout=self.timeout):
+                count = 1
+            else:
+                count = self._cache.incr(self.key)
+        if count < 1: # see CounterGuard.acquire()
+            logger.warning('jcache: %s=%s resetting to 1', self.key, count)
+            self._cache.set(self.key, 1, timeout=self.timeout)
+            count = 1
+        if count > self.limit and not force:
+            self.release()
+            return False
+        return True
+
+    def release(self):
+        try:
+            self._cache.decr(self.key)
+        except ValueError:
+            pass # expired while we held it
+
+
+GUARDS = {
+    'counter': CounterGuard,
+    'lock': LockGuard,
+}
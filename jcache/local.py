@@ -0,0 +1,199 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+    A small in-process LRU cache of unpickled `(value, stale_at)`
+    pairs, which JCache can put in front of its shared backend so
+    that fresh values can be served without any network I/O.
+
+    Entries are only served while fresh; once past `stale_at` they
+    are dropped, and JCache falls through to the shared backend (and
+    so to the usual stale handling). Note that this means a value
+    changed or deleted by another process may be served from here
+    until it would have gone stale anyway.
+
+    `max_entries` bounds the number of entries, and `max_size` (if
+    given) the approximate total size in bytes of the values, as
+    measured by `sys.getsizeof()`; least recently used entries are
+    evicted to keep within both.
+    """
+
+    def __init__(self, max_entries=1000, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, now=None):
+        """
+        Return the `(value, stale_at)` pair for `key` if we have it and
+        it's still fresh, or None.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            (value, stale_at, size) = entry
+            if stale_at < now:
+                self.size -= size
+                self.misses += 1
+                return None
+            # re-insert so it's the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return (value, stale_at)
+
+    def set(self, key, value, stale_at):
+        size = sys.getsizeof(value)
+        if self.max_size is not None and size > self.max_size:
+            self.delete(key)
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._entries[key] = (value, stale_at, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_size is not None and self.size > self.max_size):
+                (evicted, entry) = self._entries.popitem(last=False)
+                self.size -= entry[2]
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'size': self.size,
+        }
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """
+    Lets concurrent callers share a single call: while one caller's
+    `do(key, func)` is running, anyone else calling `do()` with the same
+    `key` waits for it and gets the same result (or exception) rather
+    than calling their own `func`. Anyone (including the caller whose
+    `func` it is) who gives a `timeout` waits at most that long, and
+    gets None if it's still running; it carries on for the others.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if leader:
+            if timeout is None:
+                self._run(key, flight, func)
+            else:
+                # in a thread of its own, so that we can stop waiting
+                # for it without stopping it
+                thread = threading.Thread(target=self._run, args=(key, flight, func))
+                thread.daemon = True
+                thread.start()
+
+        if not flight.done.wait(timeout):
+            return None
+        if flight.exception is not None:
+            raise flight.exception
+        return flight.value
+
+    def _run(self, key, flight, func):
+        try:
+            flight.value = func()
+        except Exception, e:
+            flight.exception = e
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class Waiter(object):
+    """
+    Waits for any number of results (see jcache.executors) on a single
+    thread, which polls them every `interval` seconds and runs only
+    while there's something to wait for. Each result comes with a
+    `concurrent.futures.Future`, which is given the value once it's
+    ready, or `default` if that's None or `deadline` passes first.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, result, future, deadline=None, default=None):
+        with self._lock:
+            self._pending.append((result, future, deadline, default))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                pending = list(self._pending)
+
+            now = time.time()
+            for item in pending:
+                (result, future, deadline, default) = item
+                try:
+                    if result.ready():
+                        value = result.get()
+                    elif deadline is not None and deadline <= now:
+                        value = None
+                    else:
+                        continue
+                except Exception, e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(default if value is None else value)
+                with self._lock:
+                    self._pending.remove(item)
+
+            time.sleep(self.interval)
@@ -0,0 +1,34 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+from jcache.benchmark import SCENARIOS, run_scenario, format_result
+
+
+class Command(BaseCommand):
+    help = "Simulate concurrent load on a JCache, and report backend ops, herd size, latency and throughput."
+    args = "[scenario ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=8, help="Number of threads (default 8)"),
+        make_option('--keys', type='int', default=20, help="Number of distinct keys (default 20)"),
+        make_option('--gets', type='int', default=200, help="Gets per thread (default 200)"),
+        make_option('--delay', type='float', default=0.05, help="Seconds each generation takes (default 0.05)"),
+        make_option('--executor', default='inline', help="Regeneration executor (default inline)"),
+        make_option('--guard', default='counter', help="Regeneration guard (default counter)"),
+    )
+
+    def handle(self, *scenarios, **options):
+        for scenario in scenarios:
+            if scenario not in SCENARIOS:
+                raise CommandError("unknown scenario %s (choose from %s)" % (scenario, ', '.join(SCENARIOS)))
+
+        for scenario in scenarios or SCENARIOS:
+            result = run_scenario(
+                scenario,
+                threads=options['threads'],
+                keys=options['keys'],
+                gets=options['gets'],
+                delay=options['delay'],
+                jcache_options={ 'executor': options['executor'], 'guard': options['guard'] },
+                )
+            self.stdout.write(format_result(result) + "\n")
@@ -0,0 +1,58 @@
+import sys
+from optparse import make_option
+from django.core.cache import DEFAULT_CACHE_ALIAS
+from django.core.management.base import BaseCommand, CommandError
+
+from jcache import get_cache
+from jcache.warm import read_manifest, tracker_manifest, warm, format_progress
+
+
+class Command(BaseCommand):
+    help = "Regenerate the keys in a manifest (or found by the access tracker) in parallel, to warm a cold JCache."
+    args = "[manifest]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--cache', default=DEFAULT_CACHE_ALIAS, help="JCache to warm (default %s)" % DEFAULT_CACHE_ALIAS),
+        make_option('--tracker', action='store_true', default=False, help="Warm the hot keys found by the access tracker"),
+        make_option('--workers', type='int', default=4, help="Number of generators to run at once (default 4)"),
+        make_option('--processes', action='store_true', default=False, help="Use processes rather than threads"),
+        make_option('--rate', type='float', default=None, help="Most generators to start a second (default unlimited)"),
+        make_option('--chunk-size', type='int', default=100, help="Keys to write at once (default 100)"),
+        make_option('--jitter', type='float', default=0.1, help="Fraction of stale time to bring stale_at forward by, at most (default 0.1)"),
+        make_option('--all', action='store_true', default=False, help="Regenerate keys that already have a value too"),
+    )
+
+    def handle(self, *manifests, **options):
+        if len(manifests) > 1:
+            raise CommandError("give one manifest at most")
+        if bool(manifests) == options['tracker']:
+            raise CommandError("give either a manifest or --tracker")
+
+        try:
+            jcache = get_cache(options['cache'])
+        except ValueError:
+            raise CommandError("no JCache called %s" % options['cache'])
+
+        if options['tracker']:
+            if jcache.tracker is None:
+                raise CommandError("%s isn't tracking its hot keys" % options['cache'])
+            entries = tracker_manifest(jcache)
+        elif manifests[0] == '-':
+            entries = read_manifest(jcache, sys.stdin)
+        else:
+            with open(manifests[0]) as lines:
+                entries = read_manifest(jcache, lines)
+
+        result = warm(
+            jcache,
+            entries,
+            workers=options['workers'],
+            processes=options['processes'],
+            rate=options['rate'],
+            chunk_size=options['chunk_size'],
+            jitter=options['jitter'],
+            everything=options['all'],
+            progress=lambda result: self.stdout.write(format_progress(result) + "\n"),
+            )
+        if not entries:
+            self.stdout.write(format_progress(result) + "\n")
@@ -0,0 +1,192 @@
+"""
+Instrumentation for JCache. Turn it on by giving a JCache `metrics`
+options (in `settings.JCACHES` or to the constructor), eg:
+
+    'metrics': { 'sink': 'statsd', 'client': statsd_client, 'key_prefix': ':' }
+
+`sink` is one of the names in `SINKS`, the dotted path of a `Sink`
+subclass, or an instance; the other options except `key_prefix` are
+passed to its constructor. If `key_prefix` is given, keys are split on
+it and the first part is reported along with the cache alias, so you
+can see (for instance) `product:123` and `product:456` together.
+
+Counters reported are:
+
+ * hit, stale, miss: the state of each key read by `get()`/`get_many()`
+ * regeneration: regenerations dispatched
+ * deferred: regenerations not dispatched because their generator
+   already had `max_concurrency` of them queued or running
+ * expired: regenerations dropped because they waited for a worker
+   for longer than their deadline
+ * error: generators that raised
+ * backoff: keys whose regeneration was suspended after an error
+
+and timings (in seconds):
+
+ * generate: how long generators took
+ * queue: how long regenerations waited before starting
+"""
+
+import bisect
+import threading
+from django.dispatch import Signal
+from django.utils.importlib import import_module
+
+
+# sent with name, kind ('counter' or 'timing'), value, alias and prefix
+metric = Signal(providing_args=['name', 'kind', 'value', 'alias', 'prefix'])
+
+
+class Sink(object):
+    """
+    Where metrics go. `prefix` is None unless the JCache was configured
+    with a `key_prefix`.
+    """
+
+    def incr(self, name, alias, prefix):
+        raise NotImplementedError
+
+    def timing(self, name, seconds, alias, prefix):
+        raise NotImplementedError
+
+
+class SignalSink(Sink):
+    """
+    Sends `jcache.metrics.metric` for each measurement.
+    """
+
+    def incr(self, name, alias, prefix):
+        metric.send(sender=self, name=name, kind='counter', value=1, alias=alias, prefix=prefix)
+
+    def timing(self, name, seconds, alias, prefix):
+        metric.send(sender=self, name=name, kind='timing', value=seconds, alias=alias, prefix=prefix)
+
+
+class CallbackSink(Sink):
+    """
+    Calls `callback(name, kind, value, alias, prefix)` for each
+    measurement; `callback` may be a dotted path.
+    """
+
+    def __init__(self, callback):
+        if isinstance(callback, basestring):
+            (module, name) = callback.rsplit('.', 1)
+            callback = getattr(import_module(module), name)
+        self.callback = callback
+
+    def incr(self, name, alias, prefix):
+        self.callback(name, 'counter', 1, alias, prefix)
+
+    def timing(self, name, seconds, alias, prefix):
+        self.callback(name, 'timing', seconds, alias, prefix)
+
+
+class StatsdSink(Sink):
+    """
+    Sends to a statsd-style `client` (anything with `incr(stat)` and
+    `timing(stat, milliseconds)`), with stats named like
+    `jcache.<alias>[.<prefix>].<name>`.
+    """
+
+    def __init__(self, client, prefix='jcache'):
+        if isinstance(client, basestring):
+            (module, name) = client.rsplit('.', 1)
+            client = getattr(import_module(module), name)
+        self.client = client
+        self.prefix = prefix
+
+    def _stat(self, name, alias, prefix):
+        parts = [self.prefix, alias or 'default']
+        if prefix is not None:
+            parts.append(prefix)
+        parts.append(name)
+        return '.'.join(parts)
+
+    def incr(self, name, alias, prefix):
+        self.client.incr(self._stat(name, alias, prefix))
+
+    def timing(self, name, seconds, alias, prefix):
+        self.client.timing(self._stat(name, alias, prefix), int(seconds * 1000))
+
+
+class Histogram(object):
+    """
+    Counts of timings falling into fixed buckets, plus a total.
+    """
+
+    # upper bounds of each bucket, in seconds; the last is unbounded
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+
+class MemorySink(Sink):
+    """
+    Keeps counters and histograms in memory, keyed by `(name, alias,
+    prefix)`; mostly useful for tests and the benchmarks.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, alias, prefix):
+        with self._lock:
+            key = (name, alias, prefix)
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def timing(self, name, seconds, alias, prefix):
+        with self._lock:
+            key = (name, alias, prefix)
+            if key not in self.timings:
+                self.timings[key] = Histogram()
+            self.timings[key].add(seconds)
+
+
+SINKS = {
+    'signal': SignalSink,
+    'callback': CallbackSink,
+    'statsd': StatsdSink,
+    'memory': MemorySink,
+}
+
+
+class Metrics(object):
+    """
+    What a JCache reports measurements through. With no sink, this
+    does nothing.
+    """
+
+    def __init__(self, alias=None, sink=None, key_prefix=None, **options):
+        if sink is not None and not isinstance(sink, Sink):
+            if sink in SINKS:
+                sink_class = SINKS[sink]
+            else:
+                (module, name) = sink.rsplit('.', 1)
+                sink_class = getattr(import_module(module), name)
+            sink = sink_class(**options)
+        self.sink = sink
+        self.alias = alias
+        self.key_prefix = key_prefix
+
+    def _prefix(self, key):
+        if self.key_prefix is None:
+            return None
+        return key.split(self.key_prefix, 1)[0]
+
+    def incr(self, name, key):
+        if self.sink is not None:
+            self.sink.incr(name, self.alias, self._prefix(key))
+
+    def timing(self, name, seconds, key):
+        if self.sink is not None:
+            self.sink.timing(name, seconds, self.alias, self._prefix(key))
@@ -0,0 +1,16 @@
+from jcache import _jcaches
+from jcache.executors import BatchExecutor
+
+
+class BatchRegenerationMiddleware(object):
+    """
+    Sends the regenerations collected by any JCaches using the batch
+    executor when each request finishes, rather than waiting for the
+    batch window to pass.
+    """
+
+    def process_response(self, request, response):
+        for jcache in _jcaches.values():
+            if isinstance(jcache.executor, BatchExecutor):
+                jcache.executor.flush()
+        return response
@@ -0,0 +1,66 @@
+"""
+How JCache stores values under `data:<key>`.
+
+Originally this was a `(value, stale_at)` tuple, or `(value, stale_at,
+cost)` with early refresh, pickled by the cache backend. JCaches with
+`envelope=True` instead store a compact envelope: a fixed header
+holding the format version, flags, `stale_at` and the generator cost,
+followed by the pickled value, which is compressed with zlib if it's
+larger than `compress_threshold` bytes. `unpack()` reads all of these,
+so you can switch between them with values already stored.
+"""
+
+import zlib
+import struct
+import cPickle as pickle
+
+
+VERSION = 1
+
+# flags
+COMPRESSED = 1
+HAS_COST = 2
+
+# version, flags, stale_at, cost
+HEADER = struct.Struct('!BBdf')
+
+
+def pack(value, stale_at, cost=None, compress_threshold=None, compress_level=6):
+    """
+    Returns an envelope holding `value`, `stale_at` and `cost`.
+    """
+    flags = 0
+    body = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if compress_threshold is not None and len(body) > compress_threshold:
+        compressed = zlib.compress(body, compress_level)
+        # not everything gets smaller
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= COMPRESSED
+    if cost is not None:
+        flags |= HAS_COST
+    else:
+        cost = 0.0
+    return HEADER.pack(VERSION, flags, stale_at, cost) + body
+
+
+def unpack(packed):
+    """
+    Returns `(value, stale_at, cost)` from an envelope or either form
+    of tuple, where `cost` (the time the generator took) may be None.
+    """
+    if isinstance(packed, tuple):
+        if len(packed) == 2:
+            (value, stale_at) = packed
+            return (value, stale_at, None)
+        return packed
+
+    (version, flags, stale_at, cost) = HEADER.unpack_from(packed)
+    if version != VERSION:
+        raise ValueError("unknown jcache envelope version %s" % version)
+    body = packed[HEADER.size:]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    if not flags & HAS_COST:
+        cost = None
+    return (pickle.loads(body), stale_at, cost)
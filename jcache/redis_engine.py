@@ -0,0 +1,277 @@
+"""
+A JCache that keeps its values in redis hashes, and makes the whole
+decision of a `get()` (read the value, see whether it's stale, and if
+so try to claim its regeneration) in one server-side script, so a
+stale read costs a single round trip rather than a `get`, an `incr` and
+a `decr`. Use it by giving a JCache in `settings.JCACHES` the `engine`
+'redis', eg:
+
+    JCACHES = {
+        'default': {
+            'engine': 'redis',
+            'client': { 'host': 'localhost', 'port': 6379, 'db': 1 },
+        },
+    }
+
+`client` is a dict of options for `redis.StrictRedis`, a redis URL, or
+a client (which mustn't decode responses). This needs the `redis`
+package, and redis 2.6 or later for scripting.
+
+Each key is a hash, named as the `cache` backend would name `data:<key>`
+(so with its key prefix and version), of:
+
+ * v: the pickled value
+ * s: when it goes stale
+ * c: how long it took to generate, if we're doing early refresh
+ * g: who's regenerating it and until when, as "<until> <token>"
+
+so the guard needs no keys of its own. Everything else (tags, backoff,
+access tracking and so on) still uses the `cache` backend, which can
+be anything. Grace copies and replicas aren't supported.
+"""
+
+import time
+import math
+import random
+import cPickle as pickle
+import redis
+from celery.utils import uuid
+
+from jcache import JCache, _make_key
+
+
+# claims g for ARGV[2] for ARGV[3] seconds from ARGV[1] if nobody else
+# has it (or ARGV[4] is '1'), returning 1 if we did
+CLAIM = """
+local now = tonumber(ARGV[1])
+local g = redis.call('HGET', KEYS[1], 'g')
+if ARGV[4] ~= '1' and g and tonumber(string.match(g, '^(%S+)')) >= now then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'g', (now + tonumber(ARGV[3])) .. ' ' .. ARGV[2])
+if redis.call('HEXISTS', KEYS[1], 'v') == 0 then
+    redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3])))
+end
+return 1
+"""
+
+# reads v, s and c; if ARGV[4] is '1' and the value is missing, or
+# stale at ARGV[1] (with its stale time moved by c times ARGV[5], for
+# early refresh), also tries to claim g as CLAIM does. Returns {v, s,
+# c, 1 if we claimed g}
+READ = """
+local now = tonumber(ARGV[1])
+local data = redis.call('HMGET', KEYS[1], 'v', 's', 'c', 'g')
+local claimed = 0
+if ARGV[4] == '1' then
+    local stale = not data[1]
+    if not stale then
+        local refresh_at = tonumber(data[2])
+        if data[3] then
+            refresh_at = refresh_at + tonumber(data[3]) * tonumber(ARGV[5])
+        end
+        stale = refresh_at < now
+    end
+    if stale and not (data[4] and tonumber(string.match(data[4], '^(%S+)')) >= now) then
+        redis.call('HSET', KEYS[1], 'g', (now + tonumber(ARGV[3])) .. ' ' .. ARGV[2])
+        if not data[1] then
+            redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3])))
+        end
+        claimed = 1
+    end
+end
+return {data[1], data[2], data[3], claimed}
+"""
+
+# releases g if ARGV[1] holds it
+RELEASE = """
+local g = redis.call('HGET', KEYS[1], 'g')
+if g and string.match(g, ' (.*)$') == ARGV[1] then
+    redis.call('HDEL', KEYS[1], 'g')
+    return 1
+end
+return 0
+"""
+
+# sets v, s and c (removed if ARGV[3] is empty) to ARGV[1], ARGV[2] and
+# ARGV[3], expiring in ARGV[4] seconds
+WRITE = """
+redis.call('HSET', KEYS[1], 'v', ARGV[1])
+redis.call('HSET', KEYS[1], 's', ARGV[2])
+if ARGV[3] == '' then
+    redis.call('HDEL', KEYS[1], 'c')
+else
+    redis.call('HSET', KEYS[1], 'c', ARGV[3])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+"""
+
+
+class HashGuard(object):
+    """
+    A guard (see jcache.guards) using the `g` field of a key's hash.
+    Like `LockGuard`, it holds a token unique to the owner and lapses
+    after `timeout` seconds; unlike it, releasing is atomic.
+    """
+
+    def __init__(self, jcache):
+        self.jcache = jcache
+
+    def acquire(self, key, version, timeout=None, force=False):
+        token = uuid()
+        if self.jcache._claim(
+                keys=[self.jcache._hash_key(key, version)],
+                args=[repr(time.time()), token, timeout or self.jcache.stale, '1' if force else '0'],
+                ):
+            return token
+        return None
+
+    def release(self, key, version, token, timeout=None):
+        self.jcache._release(keys=[self.jcache._hash_key(key, version)], args=[token])
+
+    def hold(self, key, version, token, timeout):
+        self.acquire(key, version, timeout, force=True)
+
+    def acquire_many(self, keys, version, timeout=None):
+        return dict((key, self.acquire(key, version, timeout)) for key in keys)
+
+    def release_many(self, tokens, version, timeout=None):
+        pipe = self.jcache._client.pipeline(transaction=False)
+        for (key, token) in tokens.items():
+            self.jcache._release(keys=[self.jcache._hash_key(key, version)], args=[token], client=pipe)
+        pipe.execute()
+
+
+class RedisJCache(JCache):
+
+    def __init__(self, client=None, **options):
+        JCache.__init__(self, **options)
+        if self.grace or self.replicas != 1:
+            raise ValueError("RedisJCache doesn't support grace or replicas")
+        if isinstance(client, basestring):
+            client = redis.StrictRedis.from_url(client)
+        elif client is None or isinstance(client, dict):
+            client = redis.StrictRedis(**(client or {}))
+        self._client = client
+        self.guard = HashGuard(self)
+        self._claim = client.register_script(CLAIM)
+        self._read = client.register_script(READ)
+        self._release = client.register_script(RELEASE)
+        self._write = client.register_script(WRITE)
+
+    def _hash_key(self, key, version=None):
+        return self._cache.make_key("data:%s" % key, version)
+
+    def _read_args(self, now, token, stale, generate):
+        if self.early_refresh:
+            # see JCache._refresh_at()
+            shift = self.early_refresh * math.log(1.0 - random.random())
+        else:
+            shift = 0
+        return [repr(now), token or '', 1 + (stale or self.stale), '1' if generate else '0', repr(shift)]
+
+    def _result(self, key, version, now, shift, result):
+        """
+        Turn what READ gave us into `(value, missing, claimed)`, recording
+        metrics as `_fetch()` does; `shift` is what we sent it for early
+        refresh.
+        """
+        (packed, stale_at, cost, claimed) = result
+        if packed is None:
+            self.metrics.incr('miss', key)
+            return (None, True, claimed)
+        value = pickle.loads(packed)
+        refresh_at = float(stale_at)
+        if cost is not None:
+            refresh_at += float(cost) * shift
+        if refresh_at < now:
+            self.metrics.incr('stale', key)
+        else:
+            self.metrics.incr('hit', key)
+            if self._local is not None:
+                self._local.set((key, version), value, refresh_at)
+        return (value, False, claimed)
+
+    def _fetch(self, key, version, stale, generate):
+        now = time.time()
+        token = uuid() if generate else None
+        args = self._read_args(now, token, stale, generate)
+        result = self._read(keys=[self._hash_key(key, version)], args=args)
+        (value, missing, claimed) = self._result(key, version, now, float(args[4]), result)
+        return (value, missing, token if claimed else None)
+
+    def _fetch_many(self, keys, version, stale, generate):
+        now = time.time()
+        pipe = self._client.pipeline(transaction=False)
+        tokens = {}
+        shifts = {}
+        for key in keys:
+            tokens[key] = uuid() if generate else None
+            args = self._read_args(now, tokens[key], stale, generate)
+            shifts[key] = float(args[4])
+            self._read(keys=[self._hash_key(key, version)], args=args, client=pipe)
+
+        results = {}
+        for (key, result) in zip(keys, pipe.execute()):
+            (value, missing, claimed) = self._result(key, version, now, shifts[key], result)
+            results[key] = (value, missing, tokens[key] if claimed else None)
+        return results
+
+    def _peek_many(self, keys, version=None):
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(self._hash_key(key, version), 'v', 's', 'c')
+        peeked = {}
+        for (key, (packed, stale_at, cost)) in zip(keys, pipe.execute()):
+            if packed is not None:
+                peeked[key] = (pickle.loads(packed), float(stale_at), float(cost) if cost is not None else None)
+        return peeked
+
+    def _write_args(self, value, stale_at, cost, timeout):
+        if timeout is None:
+            timeout = self.expiry or self._cache.default_timeout
+        return [
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            repr(stale_at),
+            repr(cost) if cost is not None else '',
+            int(math.ceil(timeout)),
+        ]
+
+    def set(self,
+            key,
+            value=None,
+            stale_at=None,
+            version=None,
+            timeout=None,
+            cost=None,
+            tags=None,
+            ):
+        key = self._tag_key(_make_key(key), tags)
+        if stale_at is None:
+            stale_at = time.time() + self.stale
+        if self._local is not None:
+            self._local.delete((key, version))
+        self._write(keys=[self._hash_key(key, version)], args=self._write_args(value, stale_at, cost, timeout))
+
+    def _set_many(self, entries, version=None, timeout=None):
+        pipe = self._client.pipeline(transaction=False)
+        for (key, (value, stale_at, cost)) in entries.items():
+            if self._local is not None:
+                self._local.delete((key, version))
+            self._write(
+                keys=[self._hash_key(key, version)],
+                args=self._write_args(value, stale_at, cost, timeout),
+                client=pipe,
+                )
+        pipe.execute()
+
+    def delete(self, key, version=None, tags=None):
+        key = self._tag_key(_make_key(key), tags)
+        if self._local is not None:
+            self._local.delete((key, version))
+        self._client.delete(self._hash_key(key, version))
+
+    def clear(self):
+        JCache.clear(self)
+        for name in self._client.scan_iter(match=self._cache.make_key("data:*", '*')):
+            self._client.delete(name)
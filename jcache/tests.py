@@ -1,11 +1,19 @@
 import time
+import pickle
+import hashlib
+import threading
 import django.utils.unittest as unittest
 from django.test import TestCase
 from django.core.cache.backends.locmem import LocMemCache
 from django.core.cache.backends.filebased import FileBasedCache
 from django.conf import settings
 
-from jcache import JCache
+from jcache import JCache, get_cache, invoke_async, invoke_async_batch, _generator_paths, TAG_CACHE_ENTRIES
+from jcache.executors import Executor, BatchExecutor, InlineExecutor, InlineResult
+from jcache.benchmark import CountingCache, run_scenario
+from jcache.packing import unpack
+from jcache.decorators import jcached
+from jcache.warm import read_manifest, warm
 
 
 CACHES = {
@@ -13,6 +21,7 @@ CACHES = {
     'secondary': LocMemCache('second-unique-snowflake', {}),
     'file-backed': FileBasedCache('/var/tmp/django_jcache_tests', {}),
 }
+CACHES['counting'] = CountingCache(LocMemCache('counting-unique-snowflake', {}))
 
 
 JCACHES = {
@@ -28,6 +37,8 @@ JCACHES = {
     'async': JCache(stale=2, expiry=3, cache=CACHES['file-backed']),
     # and one without expiry
     'async-noexpire': JCache(stale=2, expiry=None, cache=CACHES['file-backed']),
+    # records backend operations, so we can count round trips
+    'counting': JCache(stale=2, expiry=3, cache=CACHES['counting']),
 }
 
 
@@ -44,6 +55,97 @@ def failed_build(*args, **kwargs):
     raise Exception("message")
 
 
+failures = []
+def failing_build(*args, **kwargs):
+    failures.append(time.time())
+    raise Exception("message")
+
+
+builds = []
+def slow_counted_build(*args, **kwargs):
+    builds.append(time.time())
+    time.sleep(0.2)
+    return "result"
+
+
+batches = []
+def batch_build(calls):
+    batches.append(calls)
+    return [kwargs['param1'] for (args, kwargs) in calls]
+batch_build._jcache_options = { 'batch': True }
+
+
+def short_batch_build(calls):
+    return [1]
+short_batch_build._jcache_options = { 'batch': True }
+
+
+def limited_build(param1):
+    return param1
+limited_build._jcache_options = { 'queue': 'slow', 'priority': 3, 'max_concurrency': 1, 'deadline': 5 }
+
+
+class QueueingExecutor(Executor):
+    # keeps hold of what it's given, as if the workers were busy
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, args, task_id, routing=None):
+        self.submitted.append((args, routing))
+        return InlineResult()
+
+
+class ManyCountingCache(CountingCache):
+    # has incr_many() and decr_many(), as described in jcache.guards,
+    # each counted as a single round trip
+    def _op_many(name, op):
+        def op_many(self, keys, delta=1, version=None):
+            self.ops.append(name)
+            values = {}
+            for key in keys:
+                try:
+                    values[key] = getattr(self.cache, op)(key, delta, version=version)
+                except ValueError:
+                    pass
+            return values
+        return op_many
+
+    incr_many = _op_many('incr_many', 'incr')
+    decr_many = _op_many('decr_many', 'decr')
+
+
+class BrokenExecutor(Executor):
+    # as if the broker were down
+    def submit(self, args, task_id, routing=None):
+        raise IOError("broker unavailable")
+
+
+class ColdCache(CountingCache):
+    # the first `cold` incrs fail, as if every caller found the flag
+    # missing before any of them had created it
+    def __init__(self, cache, cold):
+        CountingCache.__init__(self, cache)
+        self.cold = cold
+
+    def incr(self, key, delta=1, version=None):
+        if self.cold:
+            self.cold -= 1
+            raise ValueError("Key '%s' not found" % key)
+        return CountingCache.incr(self, key, delta, version)
+
+
+class SlowCache(CountingCache):
+    # reads take a while, so concurrent get()s overlap
+    def get(self, key, default=None, version=None):
+        time.sleep(0.1)
+        return CountingCache.get(self, key, default, version)
+
+
+class InlineBatchExecutor(BatchExecutor):
+    def send(self, jobs, routing=()):
+        return InlineResult(invoke_async_batch(jobs))
+
+
 def param_build(*args, **kwargs):
     assert kwargs['param1']==1 and kwargs['param2']==2
     return "result"
@@ -53,6 +155,11 @@ def param_build2(param1, *args, **kwargs):
     return param1
 
 
+@jcached(cache='default', wait_on_generate=True)
+def decorated_build(a, b=2):
+    return a + b
+
+
 def enumerating_build(*args, **kwargs):
     c = CACHES['file-backed']
     #kwargs['logger'].info("running, count = %i" % c.get('build-count'))
@@ -70,6 +177,7 @@ class TestJCache(TestCase):
     def tearDown(self):
         for cache in CACHES.values():
             cache.clear()
+        CACHES['counting'].ops = []
     
     def test_preinsert(self):
         jc = JCACHES["one"]
@@ -117,6 +225,673 @@ class TestJCache(TestCase):
             "result",
             jc.get("cachekey", generator=param_build, wait_on_generate=True, param1=1, param2=2)
             )
+        # positional arguments after async_wait_on_generate all go to the
+        # generator
+        self.assertEqual("first", jc.get("positional", None, None, param_build2, True, False, "first"))
+
+    def test_get_many(self):
+        jc = JCACHES["two"]
+        jc.set("fresh", "a")
+        jc.set("stale", "b", stale_at=time.time() - 1)
+        self.assertEqual(
+            { "fresh": "a", "stale": "b", ("missing", 1): "missing" },
+            jc.get_many(
+                ["fresh", "stale", ["missing", 1]],
+                generator=param_build2,
+                wait_on_generate=True,
+                arguments={ ("missing", 1): (("missing",), {}) },
+                param1="other",
+                ),
+            )
+        self.assertEqual("missing", jc.get(("missing", 1)))
+
+    def test_get_many_flag_round_trips(self):
+        c = ManyCountingCache(LocMemCache('many-unique-snowflake', {}))
+        jc = JCache(stale=2, expiry=3, cache=c, executor=QueueingExecutor())
+        for i in range(10):
+            jc.set("key%i" % i, i, stale_at=time.time() - 1)
+            # someone else is regenerating each of them
+            c.set("flag:key%i" % i, 1)
+        c.ops = []
+        self.assertEqual(
+            dict(("key%i" % i, i) for i in range(10)),
+            jc.get_many(["key%i" % i for i in range(10)], generator=simple_build),
+            )
+        self.assertEqual(["get_many", "incr_many", "decr_many"], c.ops)
+        self.assertEqual([1] * 10, [c.get("flag:key%i" % i) for i in range(10)])
+
+    def test_get_many_failed_build(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'])
+        c = CACHES['secondary']
+        with self.assertRaises(AssertionError):
+            jc.get_many(
+                ["bad", "good"],
+                generator=param_build,
+                wait_on_generate=True,
+                arguments={ "bad": ((), { 'param1': 0, 'param2': 2 }) },
+                param1=1,
+                param2=2,
+                )
+        # the failure didn't stop the other key from being generated,
+        # and releasing its guard
+        self.assertEqual("result", jc.get("good"))
+        self.assertEqual(0, c.get("flag:good"))
+
+    def test_get_many_round_trips(self):
+        jc = JCACHES["counting"]
+        c = CACHES["counting"]
+        for i in range(10):
+            jc.set("key%i" % i, i)
+        c.ops = []
+        self.assertEqual(
+            dict(("key%i" % i, i) for i in range(10)),
+            jc.get_many(["key%i" % i for i in range(10)], generator=simple_build),
+            )
+        self.assertEqual(["get_many"], c.ops)
+
+    def test_early_refresh(self):
+        # inline, so the refresh is done by the time get() returns
+        jc = JCache(stale=2, expiry=3, cache=CACHES['file-backed'], early_refresh=1.0, executor='inline')
+        self.assertEqual("result", jc.get("cachekey", generator=simple_build, wait_on_generate=True))
+        (value, stale_at, cost) = CACHES['file-backed'].get('data:cachekey')
+        self.assertTrue(0 <= cost < 1)
+        # a very expensive generator is refreshed well before stale_at
+        jc.set("expensive", "initial", stale_at=time.time() + 60, cost=1000000)
+        jc.get("expensive", generator=param_build2, param1="next")
+        self.assertEqual("next", jc.get("expensive"))
+        # but without a cost we behave as before
+        jc.set("cheap", "initial", stale_at=time.time() + 60)
+        jc.get("cheap", generator=param_build2, param1="next")
+        self.assertEqual("initial", jc.get("cheap"))
+
+    def test_slim_task_args(self):
+        jc = get_cache('default')
+        args = jc._task_args('cachekey', None, simple_build, None, (), {})
+        self.assertEqual(
+            ('default', 'cachekey', None, 'jcache.tests.simple_build', None, (), {}),
+            args[:7],
+            )
+        self.assertEqual("result", invoke_async(*args))
+        self.assertEqual("result", jc.get('cachekey'))
+        jc.delete('cachekey')
+        self.assertEqual(None, jc.get('cachekey'))
+        # things we can't import again are sent as they are
+        generator = lambda: "result"
+        self.assertTrue(generator is jc._task_args('cachekey', None, generator, None, (), {})[3])
+        # and aren't remembered, which would keep them alive
+        self.assertFalse(generator in _generator_paths)
+        self.assertTrue(JCACHES['one'] is JCACHES['one']._task_args('cachekey', None, simple_build, None, (), {})[0])
+
+    def test_pickle(self):
+        # JCaches without an alias are sent to invoke_async as they are
+        jc = JCache(stale=2, expiry=3, cache=CACHES['file-backed'], local={ 'max_entries': 2 }, single_flight=True)
+        copy = pickle.loads(pickle.dumps(jc))
+        self.assertEqual(2, copy._local.max_entries)
+        self.assertEqual("result", invoke_async(copy, 'cachekey', None, simple_build, None, (), {}))
+        self.assertEqual("result", jc.get('cachekey'))
+        self.assertEqual("result", copy.get('cachekey'))
+        jc.delete('cachekey')
+
+        # as pickled by older versions, in tasks queued before a deploy
+        CACHES['file-backed'].set('flag:cachekey', 1)
+        old = JCache.__new__(JCache)
+        old.__setstate__({ '_cache': CACHES['file-backed'], 'stale': 2, 'expiry': 3 })
+        self.assertEqual("result", invoke_async(old, 'cachekey', None, simple_build, None, (), {}, time.time() + 2))
+        self.assertEqual(0, CACHES['file-backed'].get('flag:cachekey'))
+        jc.delete('cachekey')
+
+    def test_inline_executor(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'], executor='inline')
+        self.assertEqual(None, jc.get('cachekey', generator=simple_build))
+        self.assertEqual("result", jc.get('cachekey'))
+        # failures are kept for whoever waits on the result
+        self.assertEqual(None, jc.get('failed', generator=failed_build))
+        self.assertRaises(
+            Exception,
+            jc.get, 'failed2', generator=failed_build, wait_on_generate=True, async_wait_on_generate=True,
+            )
+        self.assertEqual(0, CACHES['secondary'].get('flag:failed'))
+
+    def test_thread_executor(self):
+        try:
+            import concurrent.futures
+        except ImportError:
+            raise unittest.SkipTest("concurrent.futures not available")
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'], executor='thread')
+        self.assertEqual(
+            "result",
+            jc.get('cachekey', generator=delayed_build, wait_on_generate=True, async_wait_on_generate=True),
+            )
+        jc.freshen('cachekey', generator=param_build2, param1="next").get(timeout=5)
+        self.assertEqual("next", jc.get('cachekey'))
+
+    def test_cold_flags(self):
+        c = ColdCache(LocMemCache('cold-unique-snowflake', {}), cold=2)
+        guard = JCache(stale=2, cache=c).guard
+        self.assertEqual(True, guard.acquire('cachekey', None, 3))
+        self.assertEqual(None, guard.acquire('cachekey', None, 3))
+        self.assertEqual({ 'cachekey': None, 'other': True }, guard.acquire_many(['cachekey', 'other'], None, 3))
+
+    def test_lock_guard(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['counting'], executor='inline', guard='lock')
+        c = CACHES['counting']
+        jc.set('cachekey', 'initial', stale_at=time.time() - 1)
+        token = jc.guard.acquire('cachekey', None, 3)
+        self.assertTrue(token is not None)
+        c.ops = []
+        # losers pay for one failed add, and nothing else
+        self.assertEqual('initial', jc.get('cachekey', generator=simple_build))
+        self.assertEqual(['get', 'add'], c.ops)
+        jc.guard.release('cachekey', None, 'not-the-owner')
+        self.assertEqual(token, c.get('lock:cachekey'))
+        jc.guard.release('cachekey', None, token)
+        self.assertEqual(None, c.get('lock:cachekey'))
+        # the winner releases the lock once it's regenerated
+        self.assertEqual('initial', jc.get('cachekey', generator=simple_build))
+        self.assertEqual('result', jc.get('cachekey'))
+        self.assertEqual(None, c.get('lock:cachekey'))
+
+    def test_metrics(self):
+        jc = JCache(
+            stale=2,
+            expiry=3,
+            cache=CACHES['secondary'],
+            executor='inline',
+            metrics={ 'sink': 'memory', 'key_prefix': ':' },
+            )
+        sink = jc.metrics.sink
+        self.assertEqual(None, jc.get('product:1', generator=simple_build))
+        self.assertEqual('result', jc.get('product:1', generator=simple_build))
+        jc.set('product:2', 'initial', stale_at=time.time() - 1)
+        self.assertEqual('initial', jc.get('product:2'))
+        # stale values aren't regenerated for a synchronous wait
+        self.assertEqual('initial', jc.get('product:2', generator=simple_build, wait_on_generate=True))
+        self.assertEqual(None, jc.get('other', generator=failed_build))
+        self.assertEqual(
+            {
+                ('miss', None, 'product'): 1,
+                ('regeneration', None, 'product'): 1,
+                ('hit', None, 'product'): 1,
+                ('stale', None, 'product'): 2,
+                ('miss', None, 'other'): 1,
+                ('regeneration', None, 'other'): 1,
+                ('error', None, 'other'): 1,
+            },
+            sink.counters,
+            )
+        self.assertEqual(1, sink.timings[('generate', None, 'product')].count)
+        self.assertEqual(2, sum(h.count for (k, h) in sink.timings.items() if k[0] == 'queue'))
+
+    def test_benchmark(self):
+        result = run_scenario('cold', threads=4, keys=2, gets=5, delay=0.1)
+        self.assertEqual(20, result['gets'])
+        self.assertEqual(1.0, result['herd'])
+
+    def test_envelope(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'], envelope=True, compress_threshold=100)
+        c = CACHES['secondary']
+        jc.set('small', 'value')
+        jc.set('large', 'x' * 1000, cost=0.5)
+        self.assertEqual(str, type(c.get('data:small')))
+        self.assertTrue(len(c.get('data:large')) < 100)
+        self.assertEqual('value', jc.get('small'))
+        self.assertEqual(('x' * 1000, 0.5), unpack(c.get('data:large'))[::2])
+        # old style tuples can still be read
+        c.set('data:old', ('old', time.time() + 2))
+        self.assertEqual('old', jc.get('old'))
+        self.assertEqual({ 'small': 'value', 'old': 'old' }, jc.get_many(['small', 'old']))
+
+    def test_jcached(self):
+        from jcache import _import_generator
+        self.assertEqual('jcache.tests.decorated_build:~1-~2', decorated_build.make_key(1))
+        self.assertEqual('jcache.tests.decorated_build:~1-~2', decorated_build.make_key(1, b=2))
+        self.assertEqual('jcache.tests.decorated_build:~1.0-~2', decorated_build.make_key(1.0))
+        self.assertEqual(
+            'jcache.tests.decorated_build:%s' % hashlib.md5('jcache.tests.decorated_build:%s-~2' % ('a' * 200)).hexdigest(),
+            decorated_build.make_key('a' * 200),
+            )
+        # different calls never share a key
+        self.assertNotEqual(decorated_build.make_key('a-b', 'c'), decorated_build.make_key('a', 'b-c'))
+        self.assertNotEqual(decorated_build.make_key(None), decorated_build.make_key('None'))
+        self.assertNotEqual(decorated_build.make_key(1), decorated_build.make_key('1'))
+        self.assertEqual('jcache.tests.decorated_build:a~-b-~None', decorated_build.make_key('a-b', None))
+        self.assertEqual(3, decorated_build(1))
+        self.assertEqual(3, get_cache('default').get('jcache.tests.decorated_build:~1-~2'))
+        self.assertEqual([3, 5], decorated_build.get_many([((1,), {}), ((2,), { 'b': 3 })]))
+        decorated_build.invalidate(1)
+        self.assertEqual(None, get_cache('default').get('jcache.tests.decorated_build:~1-~2'))
+        # the worker gets the undecorated function
+        self.assertEqual(4, _import_generator('jcache.tests.decorated_build')(1, 3))
+        get_cache('default').clear()
+
+    def test_backoff(self):
+        jc = JCache(stale=2, expiry=5, cache=CACHES['secondary'], executor='inline', guard='lock', backoff=1)
+        del failures[:]
+        jc.set('cachekey', 'initial', stale_at=time.time() - 1)
+        self.assertEqual('initial', jc.get('cachekey', generator=failing_build))
+        self.assertEqual(1, len(failures))
+        # backing off, so we don't try again
+        self.assertEqual('initial', jc.get('cachekey', generator=failing_build))
+        self.assertEqual(1, len(failures))
+        self.assertEqual(1, CACHES['secondary'].get('fail:cachekey'))
+        time.sleep(1.1)
+        self.assertEqual('initial', jc.get('cachekey', generator=failing_build))
+        self.assertEqual(2, len(failures))
+        self.assertEqual(2, CACHES['secondary'].get('fail:cachekey'))
+        # success clears the failures
+        time.sleep(2.1)
+        self.assertEqual('initial', jc.get('cachekey', generator=simple_build))
+        self.assertEqual('result', jc.get('cachekey'))
+        self.assertEqual(None, CACHES['secondary'].get('fail:cachekey'))
+
+    def test_grace(self):
+        jc = JCache(stale=2, expiry=1, cache=CACHES['secondary'], executor='inline', grace=5)
+        jc.set('cachekey', 'initial')
+        jc.set('other', 'other')
+        time.sleep(1.1)
+        self.assertEqual('initial', jc.get('cachekey', generator=simple_build))
+        self.assertEqual('result', jc.get('cachekey'))
+        self.assertEqual({ 'other': 'other' }, jc.get_many(['other']))
+        jc.delete('other')
+        self.assertEqual({}, jc.get_many(['other']))
+
+    def test_tags(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['counting'], tag_cache_timeout=0)
+        c = CACHES['counting']
+        jc.set('a', 'a', tags=['product:1', 'shop'])
+        jc.set('b', 'b', tags=['product:2', 'shop'])
+        jc.set('c', 'c', tags=['product:1'])
+        self.assertEqual('a', jc.get('a', tags=['shop', 'product:1']))
+        self.assertEqual({ 'c': 'c' }, jc.get_many(['c'], tags=['product:1']))
+        c.ops = []
+        jc.invalidate_tags('product:1')
+        self.assertEqual(['incr'], c.ops)
+        self.assertEqual(None, jc.get('a', tags=['product:1', 'shop']))
+        self.assertEqual('b', jc.get('b', tags=['product:2', 'shop']))
+        self.assertEqual(None, jc.get('c', tags=['product:1']))
+        jc.invalidate_tags('shop')
+        self.assertEqual(None, jc.get('b', tags=['product:2', 'shop']))
+
+    def test_tag_generations_cached(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['counting'])
+        c = CACHES['counting']
+        jc.set('a', 'a', tags=['shop'])
+        c.ops = []
+        self.assertEqual('a', jc.get('a', tags=['shop']))
+        self.assertEqual(['get'], c.ops)
+        jc.invalidate_tags('shop')
+        self.assertEqual(None, jc.get('a', tags=['shop']))
+        # only so many are remembered
+        for i in range(TAG_CACHE_ENTRIES + 10):
+            jc.get('a', tags=['tag%i' % i])
+        self.assertEqual(TAG_CACHE_ENTRIES, jc._tags.stats()['entries'])
+
+    def test_access_tracker(self):
+        jc = JCache(
+            stale=60,
+            expiry=120,
+            cache=CACHES['secondary'],
+            executor='inline',
+            track={ 'sample_rate': 1, 'capacity': 2, 'refresh_ahead': 30 },
+            )
+        jc.set('hot', 'initial', stale_at=time.time() + 10)
+        jc.set('warm', 'initial', stale_at=time.time() + 10)
+        jc.set('fresh', 'initial')
+        for i in range(4):
+            jc.get('hot', generator=param_build2, param1='hot')
+        for i in range(3):
+            jc.get('fresh', generator=param_build2, param1='fresh')
+        jc.get_many(['hot', 'warm'], generator=param_build2, arguments={ 'hot': ((), { 'param1': 'hot' }) }, param1='warm')
+        jc.tracker.flush()
+        self.assertEqual(
+            { ('hot', None): 5, ('warm', None): 4 },
+            dict((key, entry[0]) for (key, entry) in jc.tracker.hot_keys().items()),
+            )
+        self.assertEqual(2, jc.tracker.refresh())
+        self.assertEqual('hot', jc.get('hot'))
+        self.assertEqual('warm', jc.get('warm'))
+        self.assertEqual(0, jc.tracker.refresh())
+
+        # counts halve every flush interval, so keys no longer read drop out
+        (hot, decayed_at) = CACHES['secondary'].get(jc.tracker.cache_key)
+        CACHES['secondary'].set(jc.tracker.cache_key, (hot, decayed_at - jc.tracker.flush_interval))
+        for i in range(3):
+            jc.get('warm', generator=param_build2, param1='warm')
+        jc.tracker.flush()
+        self.assertEqual(
+            { ('hot', None): 2, ('warm', None): 5 },
+            dict((key, entry[0]) for (key, entry) in jc.tracker.hot_keys().items()),
+            )
+        (hot, decayed_at) = CACHES['secondary'].get(jc.tracker.cache_key)
+        CACHES['secondary'].set(jc.tracker.cache_key, (hot, decayed_at - 2 * jc.tracker.flush_interval))
+        self.assertEqual([('warm', None)], jc.tracker.hot_keys().keys())
+
+    def test_single_flight(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['counting'], single_flight=True)
+        c = CACHES['counting']
+        del builds[:]
+        results = []
+        def get():
+            results.append(jc.get('cachekey', generator=slow_counted_build, wait_on_generate=True))
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['result'] * 5, results)
+        self.assertEqual(1, len(builds))
+        self.assertEqual(1, c.ops.count('get'))
+
+        # callers with a budget stop waiting at their own deadline, and
+        # don't hand their default on to those without one
+        jc.delete('cachekey')
+        del builds[:]
+        results = []
+        def get(budget):
+            results.append(jc.get('cachekey', generator=slow_counted_build, wait_on_generate=True, budget=budget, default='late'))
+        threads = [threading.Thread(target=get, args=(budget,)) for budget in (None, 1, 0.05, None)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        threads[2].join()
+        self.assertTrue(time.time() - started < 0.15)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['late', 'result', 'result', 'result'], results)
+        self.assertEqual(1, len(builds))
+
+        # nor does a caller with a short budget cut short those with
+        # longer ones
+        jc.delete('cachekey')
+        del builds[:]
+        results = []
+        threads = [threading.Thread(target=get, args=(budget,)) for budget in (0.05, 2)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['late', 'result'], results)
+        self.assertEqual(1, len(builds))
+
+        # and those with a generator don't share with those without
+        jc = JCache(stale=2, expiry=3, cache=SlowCache(LocMemCache('slow-unique-snowflake', {})), single_flight=True)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(jc.get('cachekey'))),
+            threading.Thread(target=lambda: results.append(jc.get('cachekey', generator=simple_build, wait_on_generate=True))),
+            ]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual([None, 'result'], results)
+
+    def test_batch_executor(self):
+        executor = InlineBatchExecutor(window=60)
+        jc = JCache(stale=2, expiry=3, cache=CACHES['counting'], executor=executor)
+        c = CACHES['counting']
+        del batches[:]
+        for i in range(3):
+            jc.set('key%i' % i, 'initial', stale_at=time.time() - 1)
+        self.assertEqual(
+            { 'key0': 'initial', 'key1': 'initial', 'key2': 'initial' },
+            jc.get_many(
+                ['key0', 'key1', 'key2'],
+                generator=batch_build,
+                arguments=dict(('key%i' % i, ((), { 'param1': i })) for i in range(3)),
+                ),
+            )
+        self.assertEqual('initial', jc.get('key3', generator=param_build2, param1=3) or 'initial')
+        c.ops = []
+        executor.flush()
+        self.assertEqual(1, len(batches))
+        self.assertEqual(1, c.ops.count('set_many'))
+        self.assertEqual(0, c.ops.count('set'))
+        self.assertEqual(
+            { 'key0': 0, 'key1': 1, 'key2': 2, 'key3': 3 },
+            jc.get_many(['key0', 'key1', 'key2', 'key3']),
+            )
+        # waiting on a result sends the batch
+        result = jc.freshen('key0', generator=param_build2, param1='next')
+        self.assertEqual('next', result.get())
+
+    def test_batch_wrong_length(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'])
+        c = CACHES['secondary']
+        keys = ['key0', 'key1', 'key2']
+        for key in keys:
+            c.set('flag:%s' % key, 1)
+        jobs = [jc._task_args(key, None, short_batch_build, None, (), {}) for key in keys]
+        # too few values fails the whole batch, releasing every guard
+        self.assertEqual([None, None, None], invoke_async_batch(jobs))
+        self.assertEqual([0, 0, 0], [c.get('flag:%s' % key) for key in keys])
+        self.assertEqual({}, jc.get_many(keys))
+
+    def test_concurrency_limit(self):
+        executor = QueueingExecutor()
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'], executor=executor, metrics={ 'sink': 'memory' })
+        counters = jc.metrics.sink.counters
+        jc.set('key0', 'initial', stale_at=time.time() - 1)
+        jc.set('key1', 'initial', stale_at=time.time() - 1)
+        self.assertEqual('initial', jc.get('key0', generator=limited_build, param1='next'))
+        ((args, routing),) = executor.submitted
+        self.assertEqual({ 'queue': 'slow', 'priority': 3 }, routing)
+        self.assertTrue(args[7] <= time.time() + 5)
+        # another stale key with the same generator has to wait its turn
+        self.assertEqual('initial', jc.get('key1', generator=limited_build, param1='next'))
+        self.assertEqual(1, len(executor.submitted))
+        self.assertEqual(1, counters[('deferred', None, None)])
+        # but not for long; and missing keys aren't held up at all
+        self.assertEqual(None, jc.get('key2', generator=limited_build, param1='next'))
+        self.assertEqual(2, len(executor.submitted))
+        invoke_async(*executor.submitted[0][0])
+        self.assertEqual('next', jc.get('key0'))
+        # a regeneration past its deadline is dropped, giving its slot back
+        invoke_async(*(executor.submitted[1][0][:7] + (time.time() - 1, True)))
+        self.assertEqual(1, counters[('expired', None, None)])
+        self.assertEqual(None, jc.get('key2'))
+        self.assertEqual('initial', jc.get('key1', generator=limited_build, param1='next'))
+        self.assertEqual(3, len(executor.submitted))
+
+    def test_submit_failure(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'], executor=BrokenExecutor())
+        c = CACHES['secondary']
+        with self.assertRaises(IOError):
+            jc.get('cachekey', generator=limited_build, wait_on_generate=True, async_wait_on_generate=True, param1=1)
+        # the slot, guard and task record are all given back
+        self.assertEqual(0, c.get('sem:jcache.tests.limited_build'))
+        self.assertEqual(0, c.get('flag:cachekey'))
+        self.assertEqual(None, c.get('task:cachekey'))
+        with self.assertRaises(IOError):
+            jc.freshen('cachekey', generator=limited_build, param1=1)
+        self.assertEqual(0, c.get('sem:jcache.tests.limited_build'))
+        self.assertEqual(0, c.get('flag:cachekey'))
+
+    def test_warm(self):
+        jc = JCache(stale=100, expiry=300, cache=CACHES['counting'])
+        c = CACHES['counting']
+        jc.set('present', 'initial')
+        entries = read_manifest(jc, [
+            '{"key": "present", "generator": "jcache.tests.param_build2", "args": ["present"]}',
+            '{"key": ["product", 1], "generator": "jcache.tests.param_build2", "kwargs": {"param1": 1}}',
+            '',
+            '{"key": "tagged", "generator": "jcache.tests.param_build2", "args": ["tagged"], "tags": ["t"]}',
+            '{"key": "broken", "generator": "jcache.tests.failed_build"}',
+            ])
+        progress = []
+        c.ops = []
+        now = time.time()
+        result = warm(jc, entries, workers=2, rate=1000, jitter=0.5, progress=progress.append)
+        self.assertEqual((4, 2, 1, 1), (result['total'], result['warmed'], result['skipped'], result['failed']))
+        self.assertEqual(1, len(progress))
+        self.assertEqual(1, c.ops.count('set_many'))
+        self.assertEqual('initial', jc.get('present'))
+        self.assertEqual(1, jc.get(('product', 1)))
+        self.assertEqual('tagged', jc.get('tagged', tags=['t']))
+        stale_at = unpack(c.get('data:product-1'))[1]
+        self.assertTrue(now + 50 <= stale_at <= time.time() + 100)
+        # the guards were all released
+        self.assertEqual(0, c.get('flag:product-1'))
+        self.assertEqual(0, c.get('flag:broken'))
+
+    def test_replicas(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['counting'], executor='inline', replicas={ 'home:': 3 })
+        c = CACHES['counting']
+        jc.set('home:a', 'initial', stale_at=time.time() - 1)
+        jc.set('other', 'initial')
+        self.assertEqual(['set_many', 'set'], c.ops)
+        for name in ('data:home:a', 'data:home:a~1', 'data:home:a~2'):
+            self.assertEqual('initial', unpack(c.get(name))[0])
+        self.assertEqual(None, c.get('data:other~1'))
+        # every copy is stale, but only one regeneration is needed
+        del builds[:]
+        for i in range(10):
+            jc.get('home:a', generator=slow_counted_build)
+        self.assertEqual(1, len(builds))
+        for name in ('data:home:a', 'data:home:a~1', 'data:home:a~2'):
+            self.assertEqual('result', unpack(c.get(name))[0])
+        self.assertEqual({ 'home:a': 'result', 'other': 'initial' }, jc.get_many(['home:a', 'other']))
+        jc.delete('home:a')
+        self.assertEqual(None, c.get('data:home:a~2'))
+        self.assertEqual(None, jc.get('home:a'))
+
+    def test_budget(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'])
+        del builds[:]
+        started = time.time()
+        self.assertEqual(
+            'fallback',
+            jc.get('cachekey', generator=slow_counted_build, wait_on_generate=True, budget=0.05, default='fallback'),
+            )
+        self.assertTrue(time.time() - started < 0.15)
+        # the generation carried on without us
+        time.sleep(0.3)
+        self.assertEqual(1, len(builds))
+        self.assertEqual('result', jc.get('cachekey'))
+        self.assertEqual('fallback', jc.get('otherkey', default='fallback'))
+
+    def test_aget(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'], executor='thread', poll_interval=0.01)
+        jc.set('present', 'value')
+        future = jc.aget('present')
+        self.assertTrue(future.done())
+        self.assertEqual('value', future.result())
+        self.assertEqual('fallback', jc.aget('missing', default='fallback').result())
+
+        del builds[:]
+        future = jc.aget('cachekey', generator=slow_counted_build, wait_on_generate=True)
+        self.assertFalse(future.done())
+        # waits on someone else's generation work the same way
+        other = jc.aget('cachekey', generator=slow_counted_build, wait_on_generate=True, budget=0.05, default='late')
+        self.assertEqual('late', other.result(timeout=1))
+        self.assertEqual('result', future.result(timeout=1))
+        self.assertEqual(1, len(builds))
+
+    def test_wait_on_other_generation(self):
+        # someone else is already generating a missing key; we should
+        # wait for their value rather than generate our own
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'], wait_timeout=2, poll_interval=0.05)
+        c = CACHES['secondary']
+        c.set('flag:cachekey', 1)
+        c.set('task:cachekey', ('local', 'other'))
+        timer = threading.Timer(0.2, lambda: jc.set('cachekey', 'theirs'))
+        timer.start()
+        try:
+            self.assertEqual('theirs', jc.get('cachekey', generator=failed_build, wait_on_generate=True))
+        finally:
+            timer.cancel()
+        self.assertEqual(1, c.get('flag:cachekey'))
+
+    def test_local_cache(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['counting'], local={ 'max_entries': 2 })
+        c = CACHES['counting']
+        jc.set('a', 1)
+        jc.set('b', 2)
+        jc.set('c', 3)
+        c.ops = []
+        self.assertEqual(1, jc.get('a'))
+        self.assertEqual(1, jc.get('a')) # now served locally
+        self.assertEqual({ 'a': 1, 'b': 2 }, jc.get_many(['a', 'b']))
+        self.assertEqual(3, jc.get('c')) # evicts a
+        self.assertEqual(['get', 'get_many', 'get'], c.ops)
+        self.assertEqual(
+            { 'hits': 2, 'misses': 3, 'evictions': 1, 'entries': 2 },
+            dict((k, v) for (k, v) in jc._local.stats().items() if k != 'size'),
+            )
+        jc.set('c', 4) # invalidates the local copy
+        self.assertEqual(4, jc.get('c'))
+
+    def test_wait_on_other_generation_timeout(self):
+        jc = JCache(stale=2, expiry=3, cache=CACHES['secondary'], wait_timeout=0.2, poll_interval=0.05)
+        CACHES['secondary'].set('flag:cachekey', 1)
+        self.assertEqual(None, jc.get('cachekey', generator=failed_build, wait_on_generate=True))
+        future = jc.aget('cachekey', generator=failed_build, wait_on_generate=True, default='late')
+        self.assertEqual('late', future.result(timeout=1))
+
+
+class TestRedisJCache(TestCase):
+    """
+    Tests of the redis engine, which need `settings.TESTS_REDIS` to be
+    the `client` option for a redis it can use (and clear); either
+    options for a real redis, or a fake client that supports scripting.
+    """
+
+    @unittest.skipIf(not getattr(settings, 'TESTS_REDIS', None), "no redis configuration")
+    def setUp(self):
+        from jcache.redis_engine import RedisJCache
+        self.executor = QueueingExecutor()
+        self.jc = RedisJCache(
+            client=settings.TESTS_REDIS,
+            stale=2,
+            expiry=3,
+            cache=CACHES['counting'],
+            executor=self.executor,
+            )
+        self.jc.clear()
+
+    def test_stale_read(self):
+        jc = self.jc
+        c = CACHES['counting']
+        jc.set('cachekey', 'initial', stale_at=time.time() - 1)
+        c.ops = []
+        self.assertEqual('initial', jc.get('cachekey', generator=param_build2, param1='next'))
+        self.assertEqual('initial', jc.get('cachekey', generator=param_build2, param1='next'))
+        # one script call each, and only the first claimed regeneration
+        self.assertEqual([], c.ops)
+        self.assertEqual(1, len(self.executor.submitted))
+        invoke_async(*self.executor.submitted[0][0])
+        self.assertEqual(None, jc._client.hget(jc._hash_key('cachekey'), 'g'))
+        self.assertEqual('next', jc.get('cachekey', generator=param_build2, param1='other'))
+        self.assertEqual(1, len(self.executor.submitted))
+
+    def test_missing(self):
+        jc = self.jc
+        jc.executor = InlineExecutor()
+        self.assertEqual(None, jc.get('cachekey'))
+        self.assertEqual('result', jc.get('cachekey', generator=param_build2, wait_on_generate=True, param1='result'))
+        self.assertEqual('result', jc.get('cachekey'))
+        jc.delete('cachekey')
+        self.assertEqual(None, jc.get('cachekey'))
+
+    def test_get_many(self):
+        jc = self.jc
+        jc.set('a', 1, stale_at=time.time() - 1)
+        jc.set('b', 2)
+        self.assertEqual({ 'a': 1, 'b': 2 }, jc.get_many(['a', 'b', 'c'], generator=param_build2, param1='next'))
+        self.assertEqual(
+            set(['a', 'c']),
+            set(args[1] for (args, routing) in self.executor.submitted),
+            )
+        # the guards are held until the regenerations finish
+        self.assertEqual({ 'a': 1, 'b': 2 }, jc.get_many(['a', 'b', 'c'], generator=param_build2, param1='next'))
+        self.assertEqual(2, len(self.executor.submitted))
+        jc._set_many({ 'a': ('new', time.time() + 10, None), 'c': ('new', time.time() + 10, 0.5) })
+        jc.guard.release_many(dict((args[1], args[8]) for (args, routing) in self.executor.submitted), None)
+        self.assertEqual({ 'a': 'new', 'b': 2, 'c': 'new' }, jc.get_many(['a', 'b', 'c'], generator=param_build2))
+        self.assertEqual(2, len(self.executor.submitted))
 
 
 class TestJCacheAsyncRegen(TestCase):
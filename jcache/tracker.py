@@ -0,0 +1,145 @@
+"""
+Tracks which keys of a JCache are read most, so that they can be
+regenerated shortly before they go stale rather than after, when
+someone has to be served a stale value. Turn it on by giving a JCache
+(which must be in `settings.JCACHES`) `track` options, eg:
+
+    'track': { 'sample_rate': 0.01, 'capacity': 100, 'refresh_ahead': 30 }
+
+and schedule `jcache.refresh_hot_keys` with celery beat, at an interval
+somewhat shorter than `refresh_ahead`:
+
+    CELERYBEAT_SCHEDULE = {
+        'jcache-refresh-hot-keys': {
+            'task': 'jcache.refresh_hot_keys',
+            'schedule': timedelta(seconds=10),
+        },
+    }
+
+Each process samples the `get()`s that have an importable generator,
+keeping a bounded top-K of them (using the space-saving algorithm),
+and every `flush_interval` seconds merges that into a list of the
+`capacity` hottest keys kept in the cache backend. The counts there
+are halved every `flush_interval`, so keys that stop being read (or
+are invalidated) drop out. The periodic task reads that list and
+freshens those keys that are missing or will go stale within
+`refresh_ahead` seconds.
+"""
+
+import time
+import random
+import threading
+
+
+class AccessTracker(object):
+
+    def __init__(self, jcache, sample_rate=0.01, capacity=100, flush_interval=60, refresh_ahead=30):
+        self.jcache = jcache
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.refresh_ahead = refresh_ahead
+        # (key, version) -> [count, generator, stale, args, kwargs]
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._next_flush = time.time() + flush_interval
+
+    @property
+    def cache_key(self):
+        return "hot:%s" % self.jcache.alias
+
+    def record(self, key, version, generator, stale, args, kwargs):
+        """
+        Note a `get()` of `key`, whose generator has the import path
+        `generator`. Only a sample of calls are counted.
+        """
+        if random.random() >= self.sample_rate:
+            return
+        with self._lock:
+            entry = self._counts.get((key, version))
+            if entry is not None:
+                entry[0] += 1
+            else:
+                count = 1
+                if len(self._counts) >= self.capacity:
+                    # replace the least counted, taking over its count
+                    (least, least_entry) = min(self._counts.items(), key=lambda item: item[1][0])
+                    del self._counts[least]
+                    count += least_entry[0]
+                self._counts[(key, version)] = [count, generator, stale, args, kwargs]
+            flush = time.time() >= self._next_flush
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Merge what we've counted into the shared list of hot keys, and
+        start counting again. This isn't atomic, so concurrent flushes
+        from different processes can lose counts; that's fine for
+        finding the hottest keys.
+        """
+        with self._lock:
+            counts = self._counts
+            self._counts = {}
+            self._next_flush = time.time() + self.flush_interval
+        if not counts:
+            return
+
+        (hot, decayed_at) = self._read(time.time())
+        for (key, entry) in counts.items():
+            if key in hot:
+                entry[0] += hot[key][0]
+            hot[key] = entry
+        if len(hot) > self.capacity:
+            hottest = sorted(hot.items(), key=lambda item: item[1][0], reverse=True)[:self.capacity]
+            hot = dict(hottest)
+        self.jcache._cache.set(self.cache_key, (hot, decayed_at), timeout=self.flush_interval * 10)
+
+    def _read(self, now):
+        """
+        Returns the shared hot keys, with their counts halved for each
+        `flush_interval` since they last were (dropping any that reach
+        zero), and when that was.
+        """
+        stored = self.jcache._cache.get(self.cache_key)
+        if stored is None:
+            return ({}, now)
+        (hot, decayed_at) = stored
+        windows = int((now - decayed_at) / self.flush_interval)
+        if windows > 0:
+            decayed_at += windows * self.flush_interval
+            hot = dict(
+                (key, [entry[0] // 2 ** windows] + entry[1:])
+                for (key, entry) in hot.items()
+                if entry[0] // 2 ** windows
+                )
+        return (hot, decayed_at)
+
+    def hot_keys(self):
+        """
+        Returns the shared dict of `(key, version)` to `[count,
+        generator, stale, args, kwargs]`.
+        """
+        return self._read(time.time())[0]
+
+    def refresh(self):
+        """
+        Freshen hot keys which are missing or about to go stale,
+        returning how many we tried to freshen.
+        """
+        from jcache import _import_generator
+
+        by_version = {}
+        for ((key, version), entry) in self.hot_keys().items():
+            by_version.setdefault(version, []).append((key, entry))
+
+        horizon = time.time() + self.refresh_ahead
+        refreshed = 0
+        for (version, entries) in by_version.items():
+            peeked = self.jcache._peek_many([key for (key, entry) in entries], version)
+            for (key, (count, generator, stale, args, kwargs)) in entries:
+                if key in peeked and peeked[key][1] > horizon:
+                    continue
+                self.jcache.freshen(key, version, _import_generator(generator), stale, *args, **kwargs)
+                refreshed += 1
+        return refreshed
@@ -0,0 +1,202 @@
+"""
+Warms a JCache from a manifest of keys, for instance after a deploy or
+a backend failover has left it cold, without a startup herd. Run it
+with the `jcache_warm` management command.
+
+A manifest file has one JSON object per line, eg:
+
+    {"key": "product:123", "generator": "shop.views.build_product", "kwargs": {"id": 123}}
+
+with optional `args`, `version`, `stale` and `tags`. Alternatively the
+manifest can be the hot keys found by a JCache's access tracker (see
+jcache.tracker).
+
+Keys are taken in chunks. For each chunk we look up which keys are
+missing (unless warming everything), take their guards so that live
+traffic won't regenerate them too, run their generators in a bounded
+thread or process pool (no faster than `rate` a second, if given), and
+write the values with one `set_many()`. Their `stale_at` times are
+jittered, so they don't all go stale again together.
+"""
+
+import time
+import json
+import random
+import logging
+
+from jcache import _make_key, _import_generator
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_manifest(jcache, lines):
+    """
+    Returns the entries of a manifest file, as a list of `(key, version,
+    generator, stale, args, kwargs)` with the keys made as `get()`
+    would, including any tags.
+    """
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        entry = json.loads(line)
+        key = entry['key']
+        if isinstance(key, list):
+            key = tuple(key)
+        entries.append((
+            jcache._tag_key(_make_key(key), entry.get('tags')),
+            entry.get('version'),
+            entry['generator'],
+            entry.get('stale'),
+            tuple(entry.get('args', ())),
+            dict((str(name), value) for (name, value) in entry.get('kwargs', {}).items()),
+            ))
+    return entries
+
+
+def tracker_manifest(jcache):
+    """
+    Returns the hot keys found by `jcache`'s access tracker as manifest
+    entries, hottest first.
+    """
+    if jcache.tracker is None:
+        return []
+    hot = sorted(jcache.tracker.hot_keys().items(), key=lambda item: item[1][0], reverse=True)
+    return [
+        (key, version, generator, stale, args, kwargs)
+        for ((key, version), (count, generator, stale, args, kwargs)) in hot
+        ]
+
+
+def _generate(generator, args, kwargs):
+    # module level so process pools can pickle it
+    started = time.time()
+    value = _import_generator(generator)(*args, **kwargs)
+    return (value, time.time() - started)
+
+
+class RateLimiter(object):
+    """
+    Lets through at most `rate` calls to `wait()` a second (or any
+    number, if `rate` is None), by sleeping until it's the next one's
+    turn.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next = time.time()
+
+    def wait(self):
+        if not self.rate:
+            return
+        now = time.time()
+        if self._next > now:
+            time.sleep(self._next - now)
+            now = self._next
+        self._next = now + 1.0 / self.rate
+
+
+def warm(jcache,
+         entries,
+         workers=4,
+         processes=False,
+         rate=None,
+         chunk_size=100,
+         jitter=0.1,
+         everything=False,
+         progress=None):
+    """
+    Regenerate the manifest `entries` of `jcache` (see
+    `read_manifest()`) with a pool of `workers` threads, or processes if
+    `processes` is True, starting at most `rate` generators a second.
+    Values are written `chunk_size` at a time, with `stale_at` brought
+    forward by up to `jitter` of their stale time. Unless `everything`
+    is True, keys that already have a value are skipped.
+
+    `progress`, if given, is called with the results so far after each
+    chunk. Returns a dictionary of results.
+    """
+    import concurrent.futures
+    if processes:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    limiter = RateLimiter(rate)
+    result = {
+        'total': len(entries),
+        'warmed': 0,
+        'skipped': 0,
+        'failed': 0,
+        'seconds': 0.0,
+        'throughput': 0.0,
+    }
+    began = time.time()
+
+    try:
+        for start in xrange(0, len(entries), chunk_size):
+            by_version = {}
+            for entry in entries[start:start + chunk_size]:
+                by_version.setdefault(entry[1], []).append(entry)
+            for (version, chunk) in by_version.items():
+                _warm_chunk(jcache, version, chunk, pool, limiter, jitter, everything, result)
+            result['seconds'] = time.time() - began
+            done = result['warmed'] + result['failed']
+            result['throughput'] = done / result['seconds'] if result['seconds'] else 0.0
+            if progress is not None:
+                progress(result)
+    finally:
+        pool.shutdown()
+
+    return result
+
+
+def _warm_chunk(jcache, version, chunk, pool, limiter, jitter, everything, result):
+    if not everything:
+        present = jcache._peek_many([entry[0] for entry in chunk], version)
+        result['skipped'] += sum(1 for entry in chunk if entry[0] in present)
+        chunk = [entry for entry in chunk if entry[0] not in present]
+    if not chunk:
+        return
+
+    timeout = 1 + max(entry[3] or jcache.stale for entry in chunk)
+    tokens = jcache.guard.acquire_many([entry[0] for entry in chunk], version, timeout)
+    releases = dict((key, token) for (key, token) in tokens.items() if token is not None)
+    # someone else is already generating the others
+    result['skipped'] += len(chunk) - len(releases)
+
+    try:
+        futures = []
+        for (key, entry_version, generator, stale, args, kwargs) in chunk:
+            if tokens[key] is None:
+                continue
+            limiter.wait()
+            jcache.metrics.incr('regeneration', key)
+            futures.append((key, stale, pool.submit(_generate, generator, args, kwargs)))
+
+        writes = {}
+        for (key, stale, future) in futures:
+            try:
+                (value, cost) = future.result()
+            except Exception:
+                logger.exception("jcache: warming %s failed", key)
+                jcache.metrics.incr('error', key)
+                result['failed'] += 1
+                continue
+            jcache.metrics.timing('generate', cost, key)
+            stale = stale or jcache.stale
+            stale_at = time.time() + stale * (1 - jitter * random.random())
+            writes[key] = (value, stale_at, cost if jcache.early_refresh else None)
+
+        if writes:
+            jcache._set_many(writes, version=version)
+            result['warmed'] += len(writes)
+    finally:
+        if releases:
+            jcache.guard.release_many(releases, version, timeout)
+
+
+def format_progress(result):
+    return "%(warmed)i/%(total)i warmed, %(skipped)i skipped, %(failed)i failed " \
+        "in %(seconds).1fs (%(throughput).1f keys/s)" % result
@@ -1,6 +1,6 @@
 # Use setuptools if we can
 try:
-    from setuptools.core import setup
+    from setuptools import setup
 except ImportError:
     from distutils.core import setup
 
@@ -10,7 +10,7 @@ VERSION = '0.6-af4'
 setup(
     name=PACKAGE, version=VERSION,
     description="JCache support for Django",
-    packages=[ 'jcache' ],
+    packages=[ 'jcache', 'jcache.management', 'jcache.management.commands' ],
     license='MIT',
     author='Art Discovery Ltd',
     maintainer='James Aylett',
@@ -19,6 +19,12 @@ setup(
         'Django>=1.3',
         'celery',
     ],
+    extras_require={
+        # thread and process pool executors, aget() and jcache_warm
+        'futures': [ 'futures' ],
+        # jcache.redis_engine
+        'redis': [ 'redis>=2.7' ],
+    },
     # url = 'http://code.artfinder.com/projects/django-jcache/',
     classifiers=[
         'Intended Audience :: Developers',